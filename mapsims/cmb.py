@@ -95,6 +95,7 @@ class SOStandalonePrecomputedCMB(so_pysm_models.PrecomputedAlms):
         input_units="uK_CMB",
         input_reference_frequency=None,
         map_dist=None,
+        dtype=np.float64,
     ):
         """
         Equivalent of SOPrecomputedCMB to be executed outside of PySM.
@@ -103,12 +104,15 @@ class SOStandalonePrecomputedCMB(so_pysm_models.PrecomputedAlms):
         it convolves the Alms with the beam, generates a map and applies unit
         conversion. The lensing potential map corresponding to the simulation
         can be obtained by calling `get_phi_alm()`.
+        Set `dtype` to `np.float32` to return single precision maps, the
+        spherical harmonics transform is still performed in double precision.
         """
 
         filename = _get_cmb_map_string(cmb_dir, num, cmb_set, lensed, aberrated)
 
         self.iteration_num = num
         self.cmb_dir = cmb_dir
+        self.dtype = dtype
 
         super().__init__(
             filename,
@@ -149,7 +153,7 @@ class SOStandalonePrecomputedCMB(so_pysm_models.PrecomputedAlms):
             if self.nside is None:
                 raise NotImplementedError("Tube simulations for CAR not supported yet")
             output_map = np.zeros(
-                (len(ch), 3, hp.nside2npix(self.nside)), dtype=np.float64
+                (len(ch), 3, hp.nside2npix(self.nside)), dtype=self.dtype
             )
             for i, each in enumerate(ch):
                 output_map[i] = _wrap_wcs(self.get_emission(
@@ -159,7 +163,7 @@ class SOStandalonePrecomputedCMB(so_pysm_models.PrecomputedAlms):
         else:
             return _wrap_wcs(self.get_emission(
                 freqs=ch.center_frequency, fwhm=ch.beam, output_units=output_units
-            ))
+            ).astype(self.dtype, copy=False))
 
 
 def _get_default_cmb_directory():
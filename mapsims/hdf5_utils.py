@@ -0,0 +1,156 @@
+# Single file HDF5 output of MapSim, see the `output_hdf5_filename` argument.
+# Each realization is a group named with the zero-padded `num`, with one dataset
+# for each channel, with shape (nsplits, 3) + map shape.
+
+import healpy as hp
+import numpy as np
+
+# h5py is optional and needed only for HDF5 output
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# about 4 MB of float32 pixels in each chunk
+CHUNK_PIXELS = 2 ** 20
+
+
+def get_dataset_name(tag, num=0):
+    """Name of the dataset of a channel in a realization, e.g. "0000/ST0_UHF1" """
+    return "{:04d}/{}".format(num, tag)
+
+
+def open_hdf5_file(filename, comm=None):
+    """Open an HDF5 file for writing, create it if it does not exist
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file
+    comm : MPI communicator
+        If provided, all the ranks open the file with the MPI-IO driver,
+        it requires h5py built with parallel HDF5
+
+    Returns
+    -------
+    h5file : h5py.File
+        Open file
+    """
+    if h5py is None:
+        raise ImportError("HDF5 output requires h5py")
+    if comm is None:
+        return h5py.File(filename, "a")
+    if not h5py.get_config().mpi:
+        raise ValueError("Parallel HDF5 output requires h5py built with MPI support")
+    return h5py.File(filename, "a", driver="mpio", comm=comm)
+
+
+def create_map_dataset(
+    h5file, tag, num, nsplits, shape, wcs=None, unit=None, coord=None, compression=True
+):
+    """Create the dataset of a channel, or open it if it already exists
+
+    Datasets are chunked along the pixel axis, one component of one split per chunk,
+    so partial reads of pixel ranges only read the chunks they need.
+    An existing dataset with a different shape, data type or WCS, e.g. written
+    by a previous run with a different `nsplits`, raises a ValueError.
+
+    Parameters
+    ----------
+    h5file : h5py.File
+        Open file
+    tag : str
+        Channel tag
+    num : int
+        Realization number
+    nsplits : int
+        Number of splits
+    shape : tuple
+        Shape of a single component map, (npix,) for HEALPix, (ny, nx) for CAR
+    wcs : astropy.wcs.WCS
+        WCS of CAR maps, None for HEALPix
+    unit : str
+        Unit of the maps, saved in the "unit" attribute
+    coord : str
+        Reference frame of the maps, saved in the "coord" attribute
+    compression : bool
+        Compress the chunks with gzip, parallel writes require no compression
+
+    Returns
+    -------
+    dataset : h5py.Dataset
+        Dataset with shape (nsplits, 3) + shape
+    """
+    name = get_dataset_name(tag, num)
+    shape = (nsplits, 3) + tuple(shape)
+    header = None if wcs is None else wcs.to_header_string()
+    if name in h5file:
+        dataset = h5file[name]
+        if (
+            dataset.shape != shape
+            or dataset.dtype != np.float32
+            or dataset.attrs.get("wcs") != header
+        ):
+            raise ValueError(
+                "Dataset {} of {} already exists with a different shape, data type "
+                "or WCS, shape {} expected {}, remove it or write to another file".format(
+                    name, h5file.filename, dataset.shape, shape
+                )
+            )
+        return dataset
+    if wcs is None:
+        chunks = (1, 1, min(shape[2], CHUNK_PIXELS))
+    else:
+        chunks = (1, 1, min(shape[2], max(1, CHUNK_PIXELS // shape[3])), shape[3])
+    dataset = h5file.create_dataset(
+        name,
+        shape=shape,
+        dtype=np.float32,
+        chunks=chunks,
+        compression="gzip" if compression else None,
+        fillvalue=np.nan if wcs is not None else hp.UNSEEN,
+    )
+    if unit is not None:
+        dataset.attrs["unit"] = unit
+    if coord is not None:
+        dataset.attrs["coord"] = coord
+    if wcs is None:
+        dataset.attrs["nside"] = hp.npix2nside(shape[2])
+        dataset.attrs["ordering"] = "RING"
+    else:
+        dataset.attrs["wcs"] = header
+    return dataset
+
+
+def read_map(filename, tag, num=0, split=None, pixels=None):
+    """Read a map, or a range of pixels, from an HDF5 output file
+
+    Parameters
+    ----------
+    filename : str
+        Path to the HDF5 file
+    tag : str
+        Channel tag
+    num : int
+        Realization number
+    split : int
+        Split index starting from 0, if None, read all splits
+    pixels : slice or tuple of slices
+        Pixels to read, a slice of the RING ordered pixels for HEALPix
+        or a tuple of 2 slices (y, x) for CAR, if None, read the full map
+
+    Returns
+    -------
+    m : ndarray
+        Map with shape (3,) + pixels shape, or (nsplits, 3) + pixels shape
+        if `split` is None
+    """
+    if h5py is None:
+        raise ImportError("Reading HDF5 output requires h5py")
+    if pixels is None:
+        pixels = (Ellipsis,)
+    elif not isinstance(pixels, tuple):
+        pixels = (pixels,)
+    with h5py.File(filename, "r") as h5file:
+        dataset = h5file[get_dataset_name(tag, num)]
+        return dataset[(slice(None) if split is None else split, slice(None)) + pixels]
@@ -0,0 +1,215 @@
+# In-memory cache of the hitmaps and inverse variance maps of the noise simulators,
+# see the `hitmap_cache_size` and `hitmap_shared_memory` arguments of
+# `mapsims.noise.BaseNoiseSimulator`.
+# The maps can optionally be stored in named blocks of `multiprocessing.shared_memory`,
+# so processes on the same node, e.g. a pool of workers, attach to a single copy
+# of each map instead of each reading its own.
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+# each shared block starts with a fixed size header with the dtype and the shape
+# of the map and the resource tracker of the process which created it, padded
+# with spaces, its first byte is set to "{" only once the map has been written,
+# so other processes never read a partially written map
+SHARED_HEADER_SIZE = 256
+
+
+def get_default_shared_memory_prefix():
+    """Prefix of the shared memory blocks of this run, it includes the ID of the
+    current process, so the workers forked from it share the blocks, but unrelated
+    runs on the same node do not attach to each other's blocks"""
+    return "mapsims_{}".format(os.getpid())
+
+
+def _get_resource_tracker_pid():
+    # the tracker is started on the first registration and inherited by forked processes
+    return getattr(resource_tracker._resource_tracker, "_pid", None)
+
+
+def _attach_block(name):
+    """Attach to an existing shared memory block without removing it when this
+    process exits"""
+    try:
+        # Python >= 3.13, attached blocks are not registered with the resource tracker
+        return shared_memory.SharedMemory(name=name, track=False), False
+    except TypeError:
+        return shared_memory.SharedMemory(name=name), True
+
+
+class _SharedArrayHolder:
+    """Exposes the map stored in a shared memory block to numpy
+
+    The arrays created from it reference the holder, which references the
+    block, so the block is not unmapped while any array or view still uses it,
+    it is closed when the last of them is garbage collected."""
+
+    def __init__(self, block, shape, dtype):
+        self.block = block
+        weakref.finalize(self, block.close)
+        address = np.frombuffer(block.buf, dtype=np.uint8).ctypes.data
+        self.__array_interface__ = dict(
+            shape=tuple(shape),
+            typestr=np.dtype(dtype).str,
+            data=(address + SHARED_HEADER_SIZE, False),
+            version=3,
+        )
+
+
+def _unlink_blocks(blocks):
+    for block in blocks.values():
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+    blocks.clear()
+
+
+class MapCache:
+    def __init__(self, max_bytes=None, shared_memory_prefix=None):
+        """Thread-safe least recently used cache of maps with a limit in bytes
+
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum total size of the cached maps in bytes, least recently used
+            maps are removed first, the most recent map is always kept even if it
+            is larger. If None, the size is not limited
+        shared_memory_prefix : str
+            If provided, maps are stored in blocks of `multiprocessing.shared_memory`
+            named with this prefix and a hash of the key, `get` attaches to the blocks
+            created by other processes with the same prefix, e.g. the prefix of
+            `get_default_shared_memory_prefix`, requires Python 3.8 or later. The blocks
+            created by this cache are removed from the system by `unlink`, when the
+            cache is garbage collected or when the interpreter exits, the processes
+            already using them keep their maps, and when they are evicted by
+            `max_bytes`, the block is closed once no array uses it. The workers of a `multiprocessing.Pool`
+            exit without cleanup, their blocks are removed by the resource tracker
+            of the parent process when it exits. Processes which only attach to a block
+            never remove it.
+        """
+        if shared_memory_prefix is not None and shared_memory is None:
+            raise ImportError("Sharing maps in memory requires Python 3.8 or later")
+        self.max_bytes = max_bytes
+        self.shared_memory_prefix = shared_memory_prefix
+        self.nbytes = 0
+        self._maps = OrderedDict()
+        self._created_blocks = {}
+        self._lock = threading.RLock()
+        weakref.finalize(self, _unlink_blocks, self._created_blocks)
+
+    def __len__(self):
+        return len(self._maps)
+
+    def __contains__(self, key):
+        return key in self._maps
+
+    def get(self, key, default=None):
+        """Return the map with the given key, or `default` if it is not cached"""
+        with self._lock:
+            if key in self._maps:
+                self._maps.move_to_end(key)
+                return self._maps[key]
+            if self.shared_memory_prefix is not None:
+                m = self._attach(key)
+                if m is not None:
+                    self._insert(key, m)
+                    return m
+        return default
+
+    def put(self, key, m):
+        """Cache a map and return the cached map, which is a read-only
+        copy in shared memory if `shared_memory_prefix` is set"""
+        with self._lock:
+            if self.shared_memory_prefix is not None:
+                shared = self._attach(key)
+                m = self._create(key, m) if shared is None else shared
+            self._insert(key, m)
+        return m
+
+    def clear(self):
+        """Remove all maps from the cache of this process"""
+        with self._lock:
+            self._maps.clear()
+            self.nbytes = 0
+
+    def unlink(self):
+        """Clear the cache and remove from the system the shared memory
+        blocks created by this process, processes that are already using
+        them keep their maps"""
+        with self._lock:
+            self.clear()
+            _unlink_blocks(self._created_blocks)
+
+    def _insert(self, key, m):
+        if key in self._maps:
+            self.nbytes -= self._maps.pop(key).nbytes
+        self._maps[key] = m
+        self.nbytes += m.nbytes
+        if self.max_bytes is not None:
+            while self.nbytes > self.max_bytes and len(self._maps) > 1:
+                evicted_key, evicted = self._maps.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                block = self._created_blocks.pop(evicted_key, None)
+                if block is not None:
+                    _unlink_blocks({evicted_key: block})
+
+    def _get_block_name(self, key):
+        # short names, macOS limits them to 31 characters
+        key_hash = hashlib.sha256(repr(key).encode()).hexdigest()
+        return "{}_{}".format(self.shared_memory_prefix, key_hash[:12])
+
+    def _attach(self, key):
+        try:
+            block, registered = _attach_block(self._get_block_name(key))
+        except FileNotFoundError:
+            return None
+        header = bytes(block.buf[:SHARED_HEADER_SIZE])
+        if header[:1] != b"{":
+            # still being written by another process
+            block.close()
+            return None
+        header = json.loads(header.decode())
+        if registered and header["tracker"] != _get_resource_tracker_pid():
+            # before Python 3.13 attaching registers the block with the resource
+            # tracker of this process, which would remove it when this process exits,
+            # unless the tracker is the one of the owner, e.g. in forked workers
+            resource_tracker.unregister(block._name, "shared_memory")
+        m = np.asarray(
+            _SharedArrayHolder(block, header["shape"], header["dtype"])
+        )
+        m.flags.writeable = False
+        return m
+
+    def _create(self, key, m):
+        m = np.asarray(m)
+        try:
+            block = shared_memory.SharedMemory(
+                name=self._get_block_name(key),
+                create=True,
+                size=SHARED_HEADER_SIZE + max(m.nbytes, 1),
+            )
+        except FileExistsError:
+            # another process is writing the same map, keep the local copy
+            return m
+        shared = np.asarray(_SharedArrayHolder(block, m.shape, m.dtype))
+        shared[...] = m
+        header = json.dumps(
+            dict(dtype=m.dtype.str, shape=m.shape, tracker=_get_resource_tracker_pid())
+        ).encode()
+        block.buf[1:SHARED_HEADER_SIZE] = header[1:].ljust(SHARED_HEADER_SIZE - 1)
+        block.buf[:1] = header[:1]
+        self._created_blocks[key] = block
+        shared.flags.writeable = False
+        return shared
@@ -1,4 +1,8 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
 import numpy as np
 import healpy as hp
 import warnings
@@ -10,15 +14,21 @@ except ImportError:
 
 from so_models_v3 import SO_Noise_Calculator_Public_v3_1_1 as so_models
 
+try:
+    from importlib.metadata import version, PackageNotFoundError
+except ImportError:
+    from importlib_metadata import version, PackageNotFoundError
+
 # pixell is optional and needed when CAR simulations are requested
 try:
     import pixell
     import pixell.curvedsky
-    import pixell.powspec
 except:
     pixell = None
 
 from .channel_utils import parse_channels
+from .map_cache import MapCache, get_default_shared_memory_prefix
+from .seeds import DEFAULT_CHUNK_SIZE, SeedRegistry
 from .utils import DEFAULT_INSTRUMENT_PARAMETERS, RemoteData
 
 sensitivity_modes = {"baseline": 1, "goal": 2}
@@ -27,6 +37,227 @@ default_mask_value = {"healpix": hp.UNSEEN, "car": np.nan}
 _hitmap_version = "v0.2"
 
 
+def _get_package_version(name):
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return "unknown"
+
+
+# the noise spectra saved on disk depend on the versions of the noise model and of mapsims
+_noise_spectra_versions = tuple(
+    (name, _get_package_version(name)) for name in ["mapsims", "so_noise_models"]
+)
+
+
+def _to_builtin(value):
+    """Convert numpy scalars and sequences to builtin types, for hashable
+    and JSON serializable cache keys"""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_to_builtin(each) for each in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _alm2map_healpix(alms, nside):
+    """Synthesize a stack of alms with shape (..., nalm) into HEALPix maps (..., npix)
+
+    All maps are synthesized with a single multi-threaded transform
+    of pixell if available, otherwise with healpy.
+    """
+    if pixell is not None and hasattr(pixell.curvedsky, "alm2map_healpix"):
+        return pixell.curvedsky.alm2map_healpix(alms, nside=nside, spin=0)
+    maps = hp.alm2map(list(alms.reshape((-1, alms.shape[-1]))), nside, pol=False)
+    return np.reshape(maps, alms.shape[:-1] + (-1,))
+
+
+def _packed_indices(n):
+    """Band indices (i, j) of each row of the packed noise spectra of n bands,
+    the auto-spectra first, then the cross-spectra for each i and j < i,
+    see `get_noise_properties`"""
+    i, j = np.tril_indices(n, -1)
+    return np.concatenate([np.arange(n), i]), np.concatenate([np.arange(n), j])
+
+
+def _diagonal_order(n):
+    """Indices of the rows of the packed noise spectra of n bands in the ordering
+    by diagonal of `hp.synalm(new=True)`, which is the same up to 2 bands"""
+    index = {(i, j): k for k, (i, j) in enumerate(zip(*_packed_indices(n)))}
+    return [index[i + offset, i] for offset in range(n) for i in range(n - offset)]
+
+
+def _subtract_white_noise(ps, white_noise_power):
+    """Red (1/f) part of packed noise spectra, see `get_noise_properties`
+
+    The white noise power is subtracted from the auto-spectra, clipping at zero,
+    the cross-spectra, which are only due to the atmosphere, are clipped so that
+    the covariance of each pair of bands stays positive semi-definite.
+    """
+    n = len(white_noise_power)
+    rows, cols = _packed_indices(n)
+    red = np.array(ps, dtype=np.float64)
+    red[:n] = np.clip(red[:n] - np.reshape(white_noise_power, (n, 1)), 0, None)
+    limit = np.sqrt(red[rows[n:]] * red[cols[n:]])
+    red[n:] = np.clip(red[n:], -limit, limit)
+    return red
+
+
+def _unpack_spectra(ps, n):
+    """Covariance matrices with shape (nell, n, n) from packed noise spectra,
+    auto-spectra first, then the cross-spectra, see `get_noise_properties`"""
+    ps = np.asarray(ps)
+    rows, cols = _packed_indices(n)
+    cov = np.zeros((ps.shape[-1], n, n))
+    cov[:, rows, cols] = ps[: len(rows)].T
+    cov[:, cols, rows] = ps[: len(rows)].T
+    return cov
+
+
+def _sqrt_covariance(ps, n, lmax):
+    """Square roots of the covariance matrices of n fields at each ell
+
+    Parameters
+    ----------
+    ps : np.array
+        Packed spectra, see `_unpack_spectra`, zero-padded or truncated to `lmax`
+    n : int
+        Number of fields
+    lmax : int
+        Maximum ell
+
+    Returns
+    -------
+    sqrt_cov : np.array
+        Matrices with shape (lmax + 1, n, n), each times its transpose is the covariance
+    """
+    cov = np.zeros((lmax + 1, n, n))
+    unpacked = _unpack_spectra(np.asarray(ps)[..., : lmax + 1], n)
+    cov[: len(unpacked)] = unpacked
+    # the square root via eigenvectors, unlike Cholesky, also supports
+    # singular covariance matrices, e.g. at ell < 2
+    eigval, eigvec = np.linalg.eigh(cov)
+    return eigvec * np.sqrt(np.clip(eigval, 0, None))[:, None, :]
+
+
+def _correlated_alms(sqrt_cov, normal):
+    """Draw alms of n correlated fields, as `hp.synalm`, from standard normals
+
+    Parameters
+    ----------
+    sqrt_cov : np.array
+        Square roots of the covariance with shape (lmax + 1, n, n),
+        see `_sqrt_covariance`
+    normal : np.array
+        Standard normal random numbers with shape (n, 2, nalm), real and
+        imaginary parts, the imaginary part is not used for m=0
+
+    Returns
+    -------
+    alms : np.array
+        Complex alms in healpy ordering with shape (n, nalm)
+    """
+    n, lmax = sqrt_cov.shape[-1], len(sqrt_cov) - 1
+    z = (normal[:, 0] + 1j * normal[:, 1]) / np.sqrt(2)
+    z[:, : lmax + 1] = normal[:, 0, : lmax + 1]
+    alms = np.empty((n, normal.shape[-1]), dtype=np.complex128)
+    start = 0
+    # all the ell of each m with a single batched product
+    for m in range(lmax + 1):
+        stop = start + lmax + 1 - m
+        alms[:, start:stop] = np.einsum(
+            "lij,jl->il", sqrt_cov[m:], z[:, start:stop]
+        )
+        start = stop
+    return alms
+
+
+def _get_unobserved(observed):
+    """Unobserved pixels of a flattened map from the boolean mask of the observed
+    ones, either the indices of the unobserved pixels or a boolean mask, whichever
+    is smaller, both can index the map"""
+    nunobserved = observed.size - np.count_nonzero(observed)
+    index_dtype = np.dtype(np.int32 if observed.size <= 2 ** 31 - 1 else np.int64)
+    if nunobserved * index_dtype.itemsize < observed.size:
+        return np.flatnonzero(np.logical_not(observed)).astype(index_dtype)
+    return np.logical_not(observed)
+
+
+class NoisePlan:
+    def __init__(
+        self,
+        ell,
+        ps_T,
+        ps_P,
+        fsky,
+        wnoise_power,
+        weightsMap,
+        inv_sqrt_weights,
+        unobserved,
+        unit_conv,
+    ):
+        """Everything `simulate` needs for a tube, except the random numbers
+
+        Created and cached by `BaseNoiseSimulator.get_noise_plan`, so repeated
+        simulations with different seeds only draw random numbers and synthesize maps.
+        The arrays are read-only as they are shared by all the simulations.
+
+        Parameters
+        ----------
+        ell, ps_T, ps_P, fsky, wnoise_power, weightsMap
+            See the docstring of `BaseNoiseSimulator.get_noise_properties`
+        inv_sqrt_weights, unobserved
+            See the docstring of `BaseNoiseSimulator._get_inverse_sqrt_weights`,
+            None if the simulator is `homogeneous`
+        unit_conv : list of float
+            Conversion factor from uK_CMB to the output unit of each channel
+        """
+        self.ell = ell
+        self.ps_T = ps_T
+        self.ps_P = ps_P
+        self.fsky = fsky
+        self.wnoise_power = wnoise_power
+        self.weightsMap = weightsMap
+        self.inv_sqrt_weights = inv_sqrt_weights
+        self.unobserved = unobserved
+        self.unit_conv = unit_conv
+        for each in [ell, ps_T, ps_P, fsky, wnoise_power]:
+            if isinstance(each, np.ndarray):
+                each.setflags(write=False)
+        self._sqrt_covariance = {}
+
+    def get_sqrt_covariance(self, lmax, red=False):
+        """Square roots of the covariance of the bands for T and for P
+
+        Computed once per plan and lmax, see `_sqrt_covariance`.
+
+        Parameters
+        ----------
+        lmax : int
+            Maximum ell
+        red : bool
+            If True, of the red part of the spectra only, see `hybrid_ell_max`
+
+        Returns
+        -------
+        sqrt_covariance : tuple of np.array
+            Read-only arrays with shape (lmax + 1, nbands, nbands) for T and P
+        """
+        key = (lmax, red)
+        if key not in self._sqrt_covariance:
+            ps_T, ps_P = self.ps_T, self.ps_P
+            if red:
+                ps_T = _subtract_white_noise(ps_T, self.wnoise_power)
+                ps_P = _subtract_white_noise(ps_P, 2 * self.wnoise_power)
+            sqrt_covariance = tuple(
+                _sqrt_covariance(ps, len(self.unit_conv), lmax) for ps in [ps_T, ps_P]
+            )
+            for each in sqrt_covariance:
+                each.setflags(write=False)
+            self._sqrt_covariance[key] = sqrt_covariance
+        return self._sqrt_covariance[key]
+
+
 class BaseNoiseSimulator:
     def __init__(
         self,
@@ -47,6 +278,15 @@ class BaseNoiseSimulator:
         boolean_sky_fraction=False,
         channels_list=None,
         instrument_parameters=DEFAULT_INSTRUMENT_PARAMETERS,
+        dtype=np.float64,
+        noise_spectra_cache_size=32,
+        noise_spectra_cache_folder=None,
+        hybrid_ell_max=None,
+        random_engine="legacy",
+        nthreads=1,
+        hitmap_cache_folder=None,
+        hitmap_cache_size=2 ** 32,
+        hitmap_shared_memory=False,
     ):
         """An abstract base class for simulating noise maps
 
@@ -102,6 +342,49 @@ class BaseNoiseSimulator:
         channels_list: a list of channels or pass
         instrument_parameters : Path or str
             See the help of MapSims
+        dtype : numpy dtype
+            Data type of the output maps, e.g. `np.float32` to halve their memory,
+            noise spectra and spherical harmonics transforms are always computed in
+            double precision
+        noise_spectra_cache_size : int
+            Number of noise spectra kept in memory by `get_fullsky_noise_spectra`,
+            of noise plans kept in memory by `get_noise_plan` and of the weights
+            of the hitmaps, least recently used ones are removed first,
+            set to 0 to disable
+        noise_spectra_cache_folder : str
+            If provided, folder of a persistent cache of noise spectra in `.npz` files,
+            keyed on the survey parameters, so later runs do not need to call
+            the noise model, only available with `SONoiseSimulator`
+        hybrid_ell_max : int
+            If provided, the atmosphere noise is simulated in hybrid mode: only the red (1/f)
+            part of the noise spectra, i.e. the spectra minus the white noise power, is
+            synthesized, up to this ell, and the white noise is drawn in pixel space as
+            with `atmosphere=False`. Set it where the red noise becomes negligible,
+            see `validate_hybrid_noise`. Not compatible with `apply_beam_correction`.
+        random_engine : {"legacy", "seedsequence"}
+            "legacy" seeds the global numpy random state with the seed of `simulate`,
+            "seedsequence" draws each split, Stokes component and chunk of pixels from
+            an independent stream derived with `numpy.random.SeedSequence`, see
+            `mapsims.seeds`, so the maps do not depend on `nthreads`, they differ
+            from the "legacy" maps with the same seed
+        nthreads : int
+            Number of threads drawing the random numbers with the "seedsequence" engine
+        hitmap_cache_folder : str
+            If provided, folder of a persistent cache of the hitmaps and inverse variance
+            maps read from files, after the reprojection to the output geometry, in `.npy`
+            files keyed on the content of the file and the geometry, later processes
+            memory-map them instead of reading and reprojecting the original files
+        hitmap_cache_size : int
+            Maximum size in bytes of the hitmaps and inverse variance maps kept in memory
+            if `cache_hitmaps` is True, least recently used ones are removed first,
+            None for no limit
+        hitmap_shared_memory : bool or str
+            If True, the maps kept in memory are stored in `multiprocessing.shared_memory`,
+            so the processes forked from this one, e.g. the workers of `MapSims` with
+            `nprocesses` greater than 1, share a single copy of each map, if a string,
+            the prefix of the names of the shared blocks, so independent processes on
+            the same node with the same prefix, e.g. MPI ranks, share them, see
+            `mapsims.map_cache.MapCache`, requires Python 3.8 or later
         """
         if channels_list is None:
             channels_list = parse_channels(instrument_parameters=instrument_parameters)
@@ -122,7 +405,10 @@ class BaseNoiseSimulator:
             self.ell_max = (
                 ell_max if ell_max is not None else 10000 * (1.0 / self._pixheight)
             )
-            self.pixarea_map = pixell.enmap.pixsizemap(self.shape, self.wcs)
+            # area of each row, with shape (ny, 1), broadcasts against the maps
+            self.pixarea_map = pixell.enmap.pixsizemap(
+                self.shape, self.wcs, broadcastable=True
+            )
             self.map_area = pixell.enmap.area(self.shape, self.wcs)
         else:
             assert wcs is None
@@ -146,9 +432,24 @@ class BaseNoiseSimulator:
         self.no_power_below_ell = no_power_below_ell
         self.homogeneous = homogeneous
 
+        self.dtype = np.dtype(dtype)
         self.hitmap_version = _hitmap_version
         self._cache = cache_hitmaps
-        self._hmap_cache = {}
+        if hitmap_shared_memory is True:
+            hitmap_shared_memory = get_default_shared_memory_prefix()
+        self._hmap_cache = MapCache(hitmap_cache_size, hitmap_shared_memory or None)
+        self.hitmap_cache_folder = hitmap_cache_folder
+        self._weights_cache = OrderedDict()
+        self._survey_cache = {}
+        self.noise_spectra_cache_size = noise_spectra_cache_size
+        self.noise_spectra_cache_folder = noise_spectra_cache_folder
+        self._noise_spectra_cache = OrderedDict()
+        self._noise_plan_cache = OrderedDict()
+        self.hybrid_ell_max = hybrid_ell_max
+        if random_engine not in ("legacy", "seedsequence"):
+            raise ValueError("Unknown random_engine '%s'." % random_engine)
+        self.random_engine = random_engine
+        self.nthreads = nthreads
 
     def get_beam_fwhm(self, tube, band=None):
         """Get beam FWHMs in arcminutes corresponding to the tueb.
@@ -196,6 +497,91 @@ class BaseNoiseSimulator:
         """
         raise AssertionError("Must be overriden: Implement in child class")
 
+    def invalidate_survey_cache(self):
+        """Remove the cached survey objects, noise plans and weights
+
+        Survey objects are cached for the lifetime of the simulator, the cache
+        is keyed on the survey parameters, so changing an attribute, e.g.
+        `survey_efficiency`, already creates a new survey object, call this
+        to force the creation of new survey objects anyway, or after modifying
+        in place a survey object whose parameters are not known, e.g. the
+        survey of `ExternalNoiseSimulator`, or the hitmap files.
+        """
+        self._survey_cache.clear()
+        self._noise_plan_cache.clear()
+        self._weights_cache.clear()
+
+    def _cache_put(self, cache, key, value):
+        """Add a value to one of the least recently used caches,
+        see `noise_spectra_cache_size`"""
+        if self.noise_spectra_cache_size > 0:
+            cache[key] = value
+            while len(cache) > self.noise_spectra_cache_size:
+                cache.popitem(last=False)
+
+    def _get_survey_key(self, tube):
+        """Hashable key of all the parameters of the survey object of a tube
+
+        None if the parameters are not known, which disables the cache of noise spectra.
+        """
+        return None
+
+    def _get_noise_spectra_key(self, tube, ncurve_sky_fraction, return_corr):
+        """Key of the noise spectra cache, None if they cannot be cached"""
+        survey_key = self._get_survey_key(tube)
+        if survey_key is None:
+            return None
+        return survey_key + self._get_noise_model_key(
+            tube, ncurve_sky_fraction, return_corr
+        )
+
+    def _get_noise_model_key(self, tube, ncurve_sky_fraction, return_corr):
+        """Attributes of the simulator the noise spectra depend on, see
+        `_get_noise_spectra_key`"""
+        return (
+            ("ncurve_sky_fraction", float(ncurve_sky_fraction)),
+            ("ell_max", float(self.ell_max)),
+            ("deconv_beam", bool(self.apply_beam_correction)),
+            ("rolloff_ell", _to_builtin(self.rolloff_ell)),
+            ("band_indices", tuple(int(ch.noise_band_index) for ch in self.tubes[tube])),
+            ("return_corr", bool(return_corr)),
+            ("full_covariance", bool(self.full_covariance)),
+            ("no_power_below_ell", _to_builtin(self.no_power_below_ell)),
+            ("versions", _noise_spectra_versions),
+        )
+
+    def _get_noise_spectra_filename(self, key):
+        key_hash = hashlib.sha256(json.dumps(key).encode()).hexdigest()
+        return os.path.join(
+            self.noise_spectra_cache_folder, "noise_spectra_{}.npz".format(key_hash)
+        )
+
+    def _load_noise_spectra(self, key):
+        """Get noise spectra from the memory or the disk cache, None if missing"""
+        spectra = self._noise_spectra_cache.get(key)
+        if spectra is not None:
+            self._noise_spectra_cache.move_to_end(key)
+            return spectra
+        if self.noise_spectra_cache_folder is not None:
+            filename = self._get_noise_spectra_filename(key)
+            if os.path.exists(filename):
+                with np.load(filename) as f:
+                    spectra = (f["ell"], f["nells_T"], f["nells_P"])
+                self._store_noise_spectra(key, spectra, write=False)
+        return spectra
+
+    def _store_noise_spectra(self, key, spectra, write=True):
+        """Add noise spectra to the memory and, if `write`, to the disk cache"""
+        self._cache_put(self._noise_spectra_cache, key, spectra)
+        if write and self.noise_spectra_cache_folder is not None:
+            os.makedirs(self.noise_spectra_cache_folder, exist_ok=True)
+            filename = self._get_noise_spectra_filename(key)
+            # write to a temporary file first, other processes could be reading
+            temporary_filename = "{}.{}.tmp".format(filename, os.getpid())
+            with open(temporary_filename, "wb") as f:
+                np.savez(f, ell=spectra[0], nells_T=spectra[1], nells_P=spectra[2])
+            os.replace(temporary_filename, filename)
+
     def get_fullsky_noise_spectra(self, tube, ncurve_sky_fraction=1, return_corr=False):
         """Get the noise power spectra corresponding to the requested tube
         from the SO noise model code.
@@ -239,8 +625,22 @@ class BaseNoiseSimulator:
         nells_P : (3,nells) ndarray
             Same as for nells_T but for polarization.
 
+        The spectra are cached, tubes with the same survey parameters and bands,
+        e.g. LT0-LT6, share them, see `noise_spectra_cache_size` and
+        `noise_spectra_cache_folder`. The returned arrays are copies.
         """
 
+        key = self._get_noise_spectra_key(tube, ncurve_sky_fraction, return_corr)
+        spectra = None if key is None else self._load_noise_spectra(key)
+        if spectra is None:
+            spectra = self._compute_fullsky_noise_spectra(
+                tube, ncurve_sky_fraction, return_corr
+            )
+            if key is not None:
+                self._store_noise_spectra(key, spectra)
+        return tuple(each.copy() for each in spectra)
+
+    def _compute_fullsky_noise_spectra(self, tube, ncurve_sky_fraction, return_corr):
         telescope = f"{tube[0]}A"  # get LA or SA from tube name
         survey = self.get_survey(tube)
         if telescope == "SA":
@@ -269,26 +669,20 @@ class BaseNoiseSimulator:
         assert ell[0] == 2  # make sure the noise code is still returning something
         # that starts at ell=2
         ls = np.arange(ell.size + 2)
-        nells_T = np.zeros(
-            (self.channel_per_tube * (self.channel_per_tube + 1) // 2, ell.size + 2)
-        )
-        nells_P = np.zeros(
-            (self.channel_per_tube * (self.channel_per_tube + 1) // 2, ell.size + 2)
-        )
-        b_indices = [ch.noise_band_index for ch in self.tubes[tube]]
+        rows, cols = _packed_indices(self.channel_per_tube)
+        cross = slice(self.channel_per_tube, None)
+        nells_T = np.zeros((len(rows), ell.size + 2))
+        nells_P = np.zeros((len(rows), ell.size + 2))
+        b_indices = np.array([ch.noise_band_index for ch in self.tubes[tube]])
         for n_out, n_in in zip([nells_T, nells_P], [noise_ell_T, noise_ell_P]):
-            for i, b1 in enumerate(b_indices):
-                n_out[i, 2:] = n_in[b1][b1]
+            n_out[:, 2:] = np.asarray(n_in)[b_indices[rows], b_indices[cols]]
             # re-scaling if correlation coefficient is requested
-
-            counter = 0
-            for i, b1 in enumerate(b_indices):
-                for b2 in b_indices[:i]:
-                    scale = np.sqrt(n_in[b1][b1] * n_in[b2][b2]) if return_corr else 1
-                    n_out[self.channel_per_tube + counter, 2:] = (
-                        (n_in[b1][b2] / scale) if self.full_covariance else 0
-                    )
-                    counter += 1
+            if return_corr:
+                n_out[cross, 2:] /= np.sqrt(
+                    n_out[rows[cross], 2:] * n_out[cols[cross], 2:]
+                )
+            if not self.full_covariance:
+                n_out[cross] = 0
 
             if self.no_power_below_ell is not None:
                 n_out[:, ls < self.no_power_below_ell] = 0
@@ -316,7 +710,8 @@ class BaseNoiseSimulator:
         ell : np.array
             Array of :math:`\ell`
         ps_T, ps_P : np.array
-            Tube noise spectra for T and P, one row per channel, the 3rd the crosscorrelation
+            Tube noise spectra for T and P, one row per channel, then the cross-spectra
+            of each pair of channels (i, j) with j < i
         fsky : np.array
             Array of sky fractions computed as <normalized N_hits>
         wnoise_power : np.array
@@ -346,27 +741,12 @@ class BaseNoiseSimulator:
             ell, ps_T, ps_P = self.get_fullsky_noise_spectra(
                 tube, ncurve_sky_fraction=1, return_corr=True
             )
-            ps_T[: self.channel_per_tube] = (
-                ps_T[: self.channel_per_tube] * fsky[:, None] * nsplits * wnoise_scale
-            )
-            counter = 0
-            for i in range(self.channel_per_tube):
-                for j in range(i):
-                    ps_T[self.channel_per_tube + counter] *= np.sqrt(
-                        np.prod(ps_T[[i, j]], axis=0)
-                    )
-                    counter += 1
-
-            ps_P[: self.channel_per_tube] = (
-                ps_P[: self.channel_per_tube] * fsky[:, None] * nsplits * wnoise_scale
-            )
-            counter = 0
-            for i in range(self.channel_per_tube):
-                for j in range(i):
-                    ps_P[self.channel_per_tube + counter] *= np.sqrt(
-                        np.prod(ps_P[[i, j]], axis=0)
-                    )
-                    counter += 1
+            n = self.channel_per_tube
+            rows, cols = _packed_indices(n)
+            for ps in [ps_T, ps_P]:
+                ps[:n] = ps[:n] * fsky[:, None] * nsplits * wnoise_scale
+                # from correlation coefficients to cross-spectra
+                ps[n:] *= np.sqrt(ps[rows[n:]] * ps[cols[n:]])
 
         else:
             if wnoise_power is None:
@@ -377,24 +757,117 @@ class BaseNoiseSimulator:
             ps_T = np.zeros(
                 (self.channel_per_tube * (self.channel_per_tube + 1) // 2, ell.size)
             )
-            ps_T[: self.channel_per_tube] = wnoise_power[:, None] * np.ones(
-                (2, ell.size)
-            )
+            ps_T[: self.channel_per_tube] = wnoise_power[:, None] * np.ones(ell.size)
             ps_P = 2.0 * ps_T
         return ell, ps_T, ps_P, fsky, wnoise_power, weightsMap
 
+    def get_noise_plan(
+        self,
+        tube,
+        nsplits=1,
+        hitmap=None,
+        white_noise_rms=None,
+        atmosphere=True,
+        output_units="uK_CMB",
+    ):
+        """Get the noise properties of a tube which do not depend on the seed
+
+        The scaled noise spectra of `get_noise_properties`, the weights and the
+        unit conversion factors are cached in a `NoisePlan`, see `noise_spectra_cache_size`,
+        keyed on the arguments, the survey parameters and the attributes of the simulator,
+        so repeated calls to `simulate` with different seeds only draw random numbers
+        and synthesize maps. Plans of hitmaps provided as arrays are not cached, see
+        also `invalidate_survey_cache`.
+
+        Parameters
+        ----------
+        see the docstring of simulate
+
+        Returns
+        -------
+        plan : NoisePlan
+            Noise plan of the tube
+        """
+        key = self._get_noise_plan_key(
+            tube, nsplits, hitmap, white_noise_rms, atmosphere, output_units
+        )
+        if key in self._noise_plan_cache:
+            self._noise_plan_cache.move_to_end(key)
+            return self._noise_plan_cache[key]
+
+        ell, ps_T, ps_P, fsky, wnoise_power, weightsMap = self.get_noise_properties(
+            tube,
+            nsplits=nsplits,
+            hitmap=hitmap,
+            white_noise_rms=white_noise_rms,
+            atmosphere=atmosphere,
+        )
+        inv_sqrt_weights, unobserved = None, None
+        if not self.homogeneous:
+            inv_sqrt_weights, unobserved = self._get_inverse_sqrt_weights(
+                tube, hitmap, weightsMap
+            )
+        unit_conv = [
+            (1 * u.uK_CMB).to_value(
+                u.Unit(output_units), equivalencies=u.cmb_equivalencies(ch.center_frequency)
+            )
+            for ch in self.tubes[tube]
+        ]
+        plan = NoisePlan(
+            ell,
+            ps_T,
+            ps_P,
+            fsky,
+            wnoise_power,
+            weightsMap,
+            inv_sqrt_weights,
+            unobserved,
+            unit_conv,
+        )
+        if key is not None:
+            self._cache_put(self._noise_plan_cache, key, plan)
+        return plan
+
+    def _get_noise_plan_key(
+        self, tube, nsplits, hitmap, white_noise_rms, atmosphere, output_units
+    ):
+        """Key of the noise plan cache, None if the plan cannot be cached"""
+        if hitmap is not None and not isinstance(hitmap, str):
+            return None
+        survey_key = self._get_survey_key(tube)
+        if survey_key is None:
+            # survey objects whose parameters are not known are identified
+            # by the object, see `invalidate_survey_cache`
+            survey_key = (("survey", id(self.get_survey(tube))),)
+        return (
+            survey_key
+            + self._get_noise_model_key(tube, 1, True)
+            + (
+                ("homogeneous", bool(self.homogeneous)),
+                ("sky_fraction", _to_builtin(self._sky_fraction)),
+                ("boolean_sky_fraction", bool(self.boolean_sky_fraction)),
+                ("tube", tube),
+                ("nsplits", int(nsplits)),
+                ("hitmap", hitmap),
+                ("white_noise_rms", _to_builtin(white_noise_rms)),
+                ("atmosphere", bool(atmosphere)),
+                ("output_units", str(output_units)),
+            )
+        )
+
     def _validate_map(self, fmap):
         """Internal function to validate an externally provided map.
         It checks the healpix or CAR attributes against what the
-        class was initialized with. It adds a leading dimension if
-        necessary.
+        class was initialized with, there can be one map for all
+        the channels of a tube or one map per channel. It adds a
+        leading dimension if necessary.
         """
         shape = fmap.shape
         if self.healpix:
             if len(shape) == 1:
                 npix = shape[0]
             elif len(shape) == 2:
-                assert shape[0] == 1 or shape[0] == 2
+                assert shape[0] == 1 or shape[0] == self.channel_per_tube
                 npix = shape[1]
             else:
                 raise ValueError
@@ -408,7 +881,7 @@ class BaseNoiseSimulator:
             if len(shape) == 2:
                 ashape = shape
             elif len(shape) == 3:
-                assert shape[0] == 1 or shape[0] == 2
+                assert shape[0] == 1 or shape[0] == self.channel_per_tube
                 ashape = shape[-2:]
             else:
                 raise ValueError
@@ -426,14 +899,30 @@ class BaseNoiseSimulator:
         if not (isinstance(fname, str)):
             return self._validate_map(fname)
 
-        # Check if in cache
+        # Check if in cache, the key includes the modification time and the geometry
+        # because the cache can be shared with other processes
         if self._cache:
-            try:
-                return self._hmap_cache[fname]
-            except:
-                pass
+            stat = os.stat(fname)
+            key = (
+                os.path.abspath(fname),
+                stat.st_mtime_ns,
+                stat.st_size,
+                json.dumps(self._get_geometry_key()),
+            )
+            hitmap = self._hmap_cache.get(key)
+            if hitmap is not None:
+                return self._wrap_map(hitmap)
+
+        # else load, from the disk cache if available
+        cache_filename = None
+        if self.hitmap_cache_folder is not None:
+            cache_filename = self._get_hitmap_cache_filename(fname)
+            if os.path.exists(cache_filename):
+                hitmap = np.load(cache_filename, mmap_mode="r")
+                if self._cache:
+                    hitmap = self._hmap_cache.put(key, hitmap)
+                return self._wrap_map(hitmap)
 
-        # else load
         if self.healpix:
             hitmap = hp.ud_grade(
                 hp.read_map(fname, verbose=False), nside_out=self.nside
@@ -449,17 +938,51 @@ class BaseNoiseSimulator:
                 )
                 hitmap = pixell.enmap.project(hitmap, self.shape, self.wcs, order=0)
 
+        if cache_filename is not None:
+            os.makedirs(self.hitmap_cache_folder, exist_ok=True)
+            # write to a temporary file first, other processes could be reading
+            temporary_filename = "{}.{}.tmp".format(cache_filename, os.getpid())
+            with open(temporary_filename, "wb") as f:
+                np.save(f, np.asarray(hitmap))
+            os.replace(temporary_filename, cache_filename)
+
         # and then cache and return
         if self._cache:
-            self._hmap_cache[fname] = hitmap
+            hitmap = self._wrap_map(self._hmap_cache.put(key, hitmap))
         return hitmap
 
+    def _wrap_map(self, m):
+        """Add the WCS to a cached CAR map"""
+        return m if self.healpix else pixell.enmap.ndmap(m, self.wcs)
+
+    def _get_geometry_key(self):
+        """JSON serializable identifier of the output geometry"""
+        if self.healpix:
+            return ["healpix", self.nside]
+        return ["car", list(self.shape), self.wcs.to_header_string()]
+
+    def _get_hitmap_cache_filename(self, fname):
+        """Path of a map in `hitmap_cache_folder`, keyed on the SHA-256 of
+        the content of the file and on the output geometry"""
+        file_hash = hashlib.sha256()
+        with open(fname, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                file_hash.update(block)
+        key = json.dumps([file_hash.hexdigest(), self._get_geometry_key()])
+        return os.path.join(
+            self.hitmap_cache_folder,
+            "hitmap_{}.npy".format(hashlib.sha256(key.encode()).hexdigest()),
+        )
+
     def _average(self, imap):
         # Internal function to calculate <imap> general to healpix and CAR
         if self.healpix:
             assert imap.ndim == 1
         else:
             assert imap.ndim == 2
+            if self.pixarea_map.shape[-1] == 1:
+                # the area only depends on the row, sum each row first
+                imap = np.sum(imap, axis=-1, keepdims=True)
         return (self.pixarea_map * imap).sum() / (self.map_area)
 
     def _process_hitmaps(self, hitmaps):
@@ -467,12 +990,14 @@ class BaseNoiseSimulator:
         desired scheme, obtain sky fractions from them.
         """
         nhitmaps = hitmaps.shape[0]
-        assert nhitmaps == 1 or nhitmaps == 2
+        assert nhitmaps == 1 or nhitmaps == self.channel_per_tube
         if self.boolean_sky_fraction:
             raise NotImplementedError
         else:
-            for i in range(nhitmaps):
-                hitmaps[i] /= hitmaps[i].max()
+            # not in place, the maps could be cached or read-only memory maps
+            hitmaps = hitmaps / np.max(
+                hitmaps, axis=tuple(range(1, hitmaps.ndim)), keepdims=True
+            )
 
             # We define sky fraction as <Nhits>
             sky_fractions = [self._average(hitmaps[i]) for i in range(nhitmaps)]
@@ -513,7 +1038,11 @@ class BaseNoiseSimulator:
         """
 
         if hitmap is not None:
-            return self._process_hitmaps(self._load_map(hitmap))
+            hitmap = self._load_map(hitmap)
+            if hitmap.ndim == (1 if self.healpix else 2):
+                # a single map for all the channels
+                hitmap = hitmap[None]
+            return self._process_hitmaps(hitmap)
 
         # If the survey object has preloaded hitmaps. Use them. Otherwise load form files.
         survey = self.get_survey(tube)
@@ -615,8 +1144,8 @@ class BaseNoiseSimulator:
         Q,U components have 2x times the noise power (or 1/2 times the inverse 
         noise variance) of the intensity components. The inverse noise variance 
         provided by this function is for the `nsplits=1` intensity component. 
-        Two maps are stored in the leading dimension, one for each of the 
-        two correlated arrays in the dichroic tube.
+        One map per channel of the tube is stored in the leading dimension,
+        e.g. two for the correlated arrays of a dichroic tube.
 
 
         Parameters
@@ -698,9 +1227,9 @@ class BaseNoiseSimulator:
                 else pixell.enmap.ones(self.shape, self.wcs)
             )
             hitmaps = (
-                np.asarray([ones, ones])
+                np.asarray([ones] * self.channel_per_tube)
                 if self.full_covariance
-                else ones.reshape((1, -1))
+                else ones[None]
             )
             fsky = self._sky_fraction if self._sky_fraction is not None else 1
             sky_fractions = (
@@ -717,14 +1246,494 @@ class BaseNoiseSimulator:
         if len(sky_fractions) == 1:
             assert hitmaps.shape[0] == 1
             fsky = np.asarray([sky_fractions[0]] * self.channel_per_tube)
-            hitmaps = np.repeat(hitmaps, 2, axis=0)
-        elif len(sky_fractions) == 2:
-            assert len(hitmaps) == 2
+            hitmaps = np.repeat(hitmaps, self.channel_per_tube, axis=0)
+        elif len(sky_fractions) == self.channel_per_tube:
+            assert len(hitmaps) == self.channel_per_tube
             fsky = np.asarray(sky_fractions)
         else:
-            raise ValueError
+            raise ValueError(
+                "Expected 1 or {} hitmaps, got {}".format(
+                    self.channel_per_tube, len(sky_fractions)
+                )
+            )
         return fsky, hitmaps
 
+    def _get_seeds(self, tube, seed):
+        """Seed the random numbers of a simulation of a tube, see `random_engine`
+
+        With the "legacy" engine this seeds the global numpy random state and
+        returns None, otherwise returns a `SeedRegistry`.
+        """
+        if self.random_engine != "legacy":
+            return SeedRegistry(seed)
+        # This seed tuple prevents collisions with the signal sims
+        if seed is not None:
+            try:
+                iter(seed)
+            except:
+                seed = (seed,)
+            tube_id = self.tubes[tube][0].tube_id
+            seed = (0, 0, 6, tube_id) + seed
+            np.random.seed(seed)
+        return None
+
+    def _standard_normal(
+        self, component, shape, nsplits, seeds=None, tube_id=0, splits=None
+    ):
+        """Standard normal random numbers with shape (channel_per_tube, len(splits), 3) + shape
+
+        Drawn from the global numpy random state if `seeds` is None, otherwise
+        from the streams (tube_id, split, Stokes component) of `seeds`,
+        `splits` selects a subset of the `nsplits` splits, by default all.
+        """
+        if splits is None:
+            splits = range(nsplits)
+        normal = np.empty((self.channel_per_tube, len(splits), 3) + tuple(shape))
+        if seeds is None:
+            # same sequence of a single draw of all channels and splits,
+            # the splits which are not selected are discarded as they are drawn
+            for i in range(self.channel_per_tube):
+                for split in range(nsplits):
+                    block = np.random.standard_normal((3,) + tuple(shape))
+                    if split in splits:
+                        normal[i, list(splits).index(split)] = block
+            return normal
+        for i, split in enumerate(splits):
+            for i_pol in range(3):
+                normal[:, i, i_pol] = seeds.standard_normal(
+                    component,
+                    (tube_id, split, i_pol),
+                    (self.channel_per_tube, int(np.prod(shape))),
+                    nthreads=self.nthreads,
+                ).reshape((self.channel_per_tube,) + tuple(shape))
+        return normal
+
+    def _get_inverse_sqrt_weights(self, tube, hitmap, weightsMap):
+        """Inverse square root of the weights and the unobserved pixels
+
+        They are cached, if `cache_hitmaps` is True, for the default hitmaps
+        of each tube and for hitmaps provided as filenames.
+
+        Parameters
+        ----------
+        tube : str
+            Tube name
+        hitmap : str or map
+            `hitmap` argument of `simulate`
+        weightsMap : np.array
+            Weights of each channel, see `get_noise_properties`
+
+        Returns
+        -------
+        inv_sqrt_weights : np.array
+            Inverse square root of the weights with shape (channel_per_tube, npix)
+            and the `dtype` of the simulator, 0 in unobserved pixels
+        unobserved : list of np.array
+            Pixels with zero weight of each channel in the flattened maps, either
+            their indices or a boolean mask, whichever takes less memory
+        """
+        key = (tube, hitmap) if hitmap is None or isinstance(hitmap, str) else None
+        if key in self._weights_cache:
+            self._weights_cache.move_to_end(key)
+            return self._weights_cache[key]
+        weights = np.reshape(weightsMap, (self.channel_per_tube, -1))
+        good = weights != 0
+        inv_sqrt_weights = np.zeros(weights.shape, dtype=self.dtype)
+        inv_sqrt_weights[good] = 1 / np.sqrt(weights[good])
+        unobserved = [_get_unobserved(each) for each in good]
+        if self._cache and key is not None:
+            self._cache_put(self._weights_cache, key, (inv_sqrt_weights, unobserved))
+        return inv_sqrt_weights, unobserved
+
+    def _draw_white_noise(
+        self, wnoise_power, nsplits, seeds=None, tube_id=0, splits=None
+    ):
+        """Draw white noise maps in pixel space
+
+        Returns an array with shape (channel_per_tube, len(splits), 3) + shape,
+        Q and U have twice the power of I, see `_standard_normal`.
+        """
+        if self.healpix:
+            ashape = (hp.nside2npix(self.nside),)
+            sel = np.s_[:, None, None, None]
+            pmap = self.pixarea_map
+        else:
+            ashape = self.shape[-2:]
+            sel = np.s_[:, None, None, None, None]
+            pmap = self.pixarea_map
+        spowr = np.sqrt(wnoise_power[sel] / pmap)
+        output_map = (
+            spowr
+            * self._standard_normal(
+                "noise_white", ashape, nsplits, seeds, tube_id, splits
+            )
+        ).astype(self.dtype, copy=False)
+        output_map[:, :, 1:, :] = output_map[:, :, 1:, :] * np.sqrt(2.0)
+        return output_map
+
+    def _get_pixel_area(self, pix, npix):
+        """Area of the pixels in the slice `pix` of the flattened maps with `npix` pixels"""
+        if self.healpix:
+            return self.pixarea_map
+        pixarea = np.asarray(self.pixarea_map)
+        if pixarea.shape[-1] > 1:
+            # geometries where the area is not constant along the rows
+            return pixarea.reshape(-1)[pix]
+        start, stop, _ = pix.indices(npix)
+        return pixarea[np.arange(start, stop) // self.shape[-1], 0]
+
+    def _simulate_white_noise(
+        self,
+        output_map,
+        wnoise_power,
+        nsplits,
+        splits,
+        seeds,
+        tube_id,
+        inv_sqrt_weights,
+        mask_value,
+        unit_conv,
+    ):
+        """Fill `output_map` with white noise maps, one chunk of pixels at a time
+
+        Draws the same random numbers as `_draw_white_noise` and applies to each chunk
+        the white noise power, the polarization factor, the hitmap weighting, the mask
+        and the unit conversion of `simulate`, so the temporary memory does not depend
+        on the size of the maps.
+
+        Parameters
+        ----------
+        output_map : ndarray
+            C-contiguous output array with shape (channel_per_tube, len(splits), 3) + shape,
+            it can be single precision or a `np.memmap`
+        wnoise_power : np.array
+            White noise power of each channel, see `get_noise_properties`
+        nsplits, splits, seeds, tube_id
+            See `_standard_normal`
+        inv_sqrt_weights : np.array
+            Inverse square root of the weights of each channel, see
+            `_get_inverse_sqrt_weights`, None if `homogeneous`
+        mask_value : float
+            Value of the pixels with zero weight
+        unit_conv : list of float
+            Unit conversion factor of each channel
+        """
+        dtype = output_map.dtype
+        pixels = np.asarray(output_map).reshape(output_map.shape[:3] + (-1,))
+        if not np.shares_memory(pixels, output_map):
+            raise ValueError("The output array must be C-contiguous")
+        npix = pixels.shape[-1]
+        chunk_size = DEFAULT_CHUNK_SIZE
+        nchunks = -(-npix // chunk_size)
+
+        def fill(i, i_split, i_pol, chunk, normal):
+            pix = slice(chunk * chunk_size, (chunk + 1) * chunk_size)
+            area = self._get_pixel_area(pix, npix)
+            block = (np.sqrt(wnoise_power[i] / area) * normal).astype(dtype, copy=False)
+            if i_pol > 0:
+                block = (block * np.sqrt(2.0)).astype(dtype, copy=False)
+            if inv_sqrt_weights is not None:
+                # Normalize on the Effective sky fraction, see `simulate`
+                block *= inv_sqrt_weights[i, pix]
+                block[inv_sqrt_weights[i, pix] == 0] = mask_value
+            block *= unit_conv[i]
+            pixels[i, i_split, i_pol, pix] = block
+
+        if seeds is None:
+            # same sequence of a single draw of all channels and splits
+            for i in range(self.channel_per_tube):
+                for split in range(nsplits):
+                    for i_pol in range(3):
+                        for chunk in range(nchunks):
+                            normal = np.random.standard_normal(
+                                min(chunk_size, npix - chunk * chunk_size)
+                            )
+                            if split in splits:
+                                fill(i, splits.index(split), i_pol, chunk, normal)
+            return
+
+        def draw(key, chunk):
+            return seeds.standard_normal_chunk(
+                "noise_white", key, chunk, (self.channel_per_tube, npix), chunk_size
+            )
+
+        executor = ThreadPoolExecutor(self.nthreads) if self.nthreads > 1 else None
+        try:
+            for i_split, split in enumerate(splits):
+                for i_pol in range(3):
+                    key = (tube_id, split, i_pol)
+                    # draw nthreads chunks in parallel at a time
+                    for first in range(0, nchunks, self.nthreads):
+                        chunks = range(first, min(first + self.nthreads, nchunks))
+                        if executor is None:
+                            normals = [draw(key, chunk) for chunk in chunks]
+                        else:
+                            normals = executor.map(lambda c: draw(key, c), chunks)
+                        for chunk, normal in zip(chunks, normals):
+                            for i in range(self.channel_per_tube):
+                                fill(i, i_split, i_pol, chunk, normal[i])
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _draw_alms(self, sqrt_covariance, lmax, split, seeds, tube_id):
+        """Draw the alms of a split with shape (channel_per_tube, 3, nalm)
+        from the streams of `seeds`, see `_correlated_alms`"""
+        nalm = hp.Alm.getsize(lmax)
+        return np.array(
+            [
+                _correlated_alms(
+                    sqrt_covariance[min(i_pol, 1)],
+                    seeds.standard_normal(
+                        "noise_atmosphere",
+                        (tube_id, split, i_pol),
+                        (self.channel_per_tube, 2, nalm),
+                        nthreads=self.nthreads,
+                    ),
+                )
+                for i_pol in range(3)
+            ]
+        ).swapaxes(0, 1)
+
+    def _get_synthesis_lmax(self, ps):
+        """Default maximum ell of the synthesis, 3 * nside - 1 for HEALPix
+        and the length of the spectra for CAR"""
+        return 3 * self.nside - 1 if self.healpix else np.shape(ps)[-1] - 1
+
+    def _synthesize_noise(
+        self,
+        ps_T,
+        ps_P,
+        nsplits,
+        lmax=None,
+        seeds=None,
+        tube_id=0,
+        splits=None,
+        sqrt_covariance=None,
+    ):
+        """Synthesize noise maps from the packed noise spectra
+
+        Parameters
+        ----------
+        ps_T, ps_P : np.array
+            Noise spectra, see `get_noise_properties`
+        nsplits : int
+            Number of splits
+        lmax : int
+            Maximum ell of the synthesis, see `_get_synthesis_lmax`
+        seeds : SeedRegistry
+            If provided, draw the alms from its streams, otherwise from
+            the global numpy random state
+        tube_id : int
+            Integer ID of the tube, key of the streams of `seeds`
+        splits : list of ints
+            Indices of the splits to synthesize, by default all, with the global
+            random state the alms of the other splits are drawn and discarded
+        sqrt_covariance : tuple of np.array
+            Square roots of the covariance of the spectra for T and P up to `lmax`,
+            used with `seeds`, see `NoisePlan.get_sqrt_covariance`, computed
+            from the spectra if not provided
+
+        Returns
+        -------
+        output_map : ndarray or ndmap
+            Maps with shape (channel_per_tube, len(splits), 3) + shape
+        """
+        if splits is None:
+            splits = range(nsplits)
+        splits = list(splits)
+        if seeds is None:
+            # the global state draws the alms of all splits in sequence,
+            # the white noise of hybrid mode is drawn after them
+            draws = range(nsplits)
+        else:
+            draws = splits
+        n = self.channel_per_tube
+        if lmax is None:
+            lmax = self._get_synthesis_lmax(ps_T)
+        if seeds is not None and sqrt_covariance is None:
+            sqrt_covariance = [_sqrt_covariance(ps, n, lmax) for ps in [ps_T, ps_P]]
+        if self.healpix:
+            npix = hp.nside2npix(self.nside)
+            output_map = np.zeros((n, len(splits), 3, npix), dtype=self.dtype)
+            # hp.synalm orders the cross-spectra by diagonal
+            order = _diagonal_order(n)
+            for split in draws:
+                if seeds is not None:
+                    alms = self._draw_alms(
+                        sqrt_covariance, lmax, split, seeds, tube_id
+                    )
+                    output_map[:, splits.index(split)] = _alm2map_healpix(
+                        alms, self.nside
+                    )
+                    continue
+                # draw the alms in the same order of separate hp.synfast calls
+                # for each Stokes component, then synthesize all bands and
+                # components of the split together
+                alms = np.array(
+                    [
+                        np.reshape(
+                            hp.synalm(
+                                np.asarray(ps_T if i_pol == 0 else ps_P)[order],
+                                lmax=lmax,
+                                new=True,
+                            ),
+                            (n, -1),
+                        )
+                        for i_pol in range(3)
+                    ]
+                )
+                if split in splits:
+                    output_map[:, splits.index(split)] = _alm2map_healpix(
+                        alms.swapaxes(0, 1), self.nside
+                    )
+        else:
+            output_map = pixell.enmap.zeros(
+                (n, len(splits), 3) + self.shape, self.wcs, dtype=self.dtype
+            )
+            # covariance matrices with shape (n, n, nell)
+            cov_T, cov_P = [
+                np.moveaxis(_unpack_spectra(np.asarray(ps)[..., : lmax + 1], n), 0, -1)
+                for ps in [ps_T, ps_P]
+            ]
+            split_map = pixell.enmap.empty((n, 3) + self.shape, self.wcs)
+            for split in draws:
+                if seeds is not None:
+                    alms = self._draw_alms(
+                        sqrt_covariance, lmax, split, seeds, tube_id
+                    )
+                    pixell.curvedsky.alm2map(alms, split_map, spin=0)
+                    output_map[:, splits.index(split)] = split_map
+                    continue
+                # draw the alms in the same order of separate rand_map calls
+                # for each Stokes component, then synthesize all bands and
+                # components of the split with a single transform
+                alms = np.array(
+                    [
+                        pixell.curvedsky.rand_alm_healpy(cov_T if i_pol == 0 else cov_P)
+                        for i_pol in range(3)
+                    ]
+                )
+                if split in splits:
+                    pixell.curvedsky.alm2map(alms.swapaxes(0, 1), split_map, spin=0)
+                    output_map[:, splits.index(split)] = split_map
+        return output_map
+
+    def _simulate_hybrid_noise(
+        self,
+        ps_T,
+        ps_P,
+        wnoise_power,
+        nsplits,
+        seeds=None,
+        tube_id=0,
+        splits=None,
+        sqrt_covariance=None,
+    ):
+        """Synthesize the red part of the noise up to `hybrid_ell_max`
+        and add white noise drawn in pixel space, `sqrt_covariance` is
+        the one of the red spectra, see `_synthesize_noise`"""
+        if self.apply_beam_correction:
+            raise NotImplementedError(
+                "Beam correction is not currently implemented for hybrid noise sims."
+            )
+        if wnoise_power is None:
+            raise AssertionError(
+                " Survey white noise level not specified. Cannot generate hybrid noise"
+            )
+        output_map = self._synthesize_noise(
+            _subtract_white_noise(ps_T, wnoise_power),
+            _subtract_white_noise(ps_P, 2 * wnoise_power),
+            nsplits,
+            lmax=self.hybrid_ell_max,
+            seeds=seeds,
+            tube_id=tube_id,
+            splits=splits,
+            sqrt_covariance=sqrt_covariance,
+        )
+        output_map += self._draw_white_noise(
+            wnoise_power, nsplits, seeds, tube_id, splits
+        )
+        return output_map
+
+    def validate_hybrid_noise(
+        self, tube, seed=None, nsplits=1, white_noise_rms=None, delta_ell=None, rtol=0.1
+    ):
+        """Compare the spectra of a hybrid noise realization with the noise spectra
+
+        The hybrid mode, see `hybrid_ell_max`, neglects the red noise above
+        `hybrid_ell_max`. This simulates a hybrid realization before the hitmap
+        weighting, measures the spectra of each band, with `hp.anafast` for HEALPix
+        and `pixell.curvedsky.map2alm` for CAR, and compares them with the noise
+        spectra used by the full harmonic synthesis, averaging the ratio of measured
+        and expected spectra in bins of `delta_ell`. The ell where the expected
+        spectra are zero, e.g. below `no_power_below_ell`, are excluded.
+        CAR geometries which do not cover the full sky are only corrected
+        for their sky fraction, so the measured spectra are less accurate.
+
+        Parameters
+        ----------
+        tube : str
+            Specify a tube (for SO: ST0-ST3, LT0-LT6) see the `tubes` attribute
+        seed, nsplits, white_noise_rms
+            See the docstring of simulate, only the first split is compared
+        delta_ell : int
+            Width of the ell bins, by default `ell_max` // 20
+        rtol : float
+            Tolerance on the relative difference of the binned spectra,
+            cosmic variance requires wider bins at low resolution
+
+        Returns
+        -------
+        validation : dict
+            "ell": centers of the bins, "ratio": binned ratio of measured and expected
+            spectra with shape (channel_per_tube, 2, nbins), for T and P,
+            "relative_error": absolute value of ratio - 1,
+            "within_tolerance": True if all relative errors are below `rtol`,
+            bins without any ell with non-zero expected spectra are NaN and ignored
+        """
+        if self.hybrid_ell_max is None:
+            raise ValueError("Set hybrid_ell_max to validate the hybrid mode")
+        seeds = self._get_seeds(tube, seed)
+        ell, ps_T, ps_P, fsky, wnoise_power, weightsMap = self.get_noise_properties(
+            tube, nsplits=nsplits, white_noise_rms=white_noise_rms, atmosphere=True
+        )
+        output_map = self._simulate_hybrid_noise(
+            ps_T, ps_P, wnoise_power, nsplits, seeds, self.tubes[tube][0].tube_id
+        )
+        lmax = min(self._get_synthesis_lmax(ps_T), np.shape(ps_T)[-1] - 1)
+        if delta_ell is None:
+            delta_ell = max(1, int(self.ell_max) // 20)
+        bin_edges = np.arange(max(2, self.no_power_below_ell or 0), lmax + 2, delta_ell)
+        ratio = np.full((self.channel_per_tube, 2, len(bin_edges) - 1), np.nan)
+        for i in range(self.channel_per_tube):
+            if self.healpix:
+                cl = hp.anafast(output_map[i, 0], lmax=lmax)
+            else:
+                alm = pixell.curvedsky.map2alm(output_map[i, 0], lmax=lmax, spin=0)
+                cl = hp.alm2cl(alm) / (self.map_area / (4 * np.pi))
+            # Q and U are independent fields with the same spectrum,
+            # so it is the average of EE and BB, or of QQ and UU
+            for j, (measured_cl, expected_cl) in enumerate(
+                [(cl[0], ps_T[i]), ((cl[1] + cl[2]) / 2, ps_P[i])]
+            ):
+                for b, (low, high) in enumerate(zip(bin_edges[:-1], bin_edges[1:])):
+                    expected = expected_cl[low:high]
+                    valid = expected > 0
+                    if np.any(valid):
+                        ratio[i, j, b] = np.mean(
+                            measured_cl[low:high][valid] / expected[valid]
+                        )
+        relative_error = np.abs(ratio - 1)
+        return dict(
+            ell=(bin_edges[:-1] + bin_edges[1:] - 1) / 2,
+            ratio=ratio,
+            relative_error=relative_error,
+            within_tolerance=bool(
+                np.all(relative_error[np.isfinite(relative_error)] < rtol)
+            ),
+        )
+
     def simulate(
         self,
         tube,
@@ -735,6 +1744,8 @@ class BaseNoiseSimulator:
         atmosphere=True,
         hitmap=None,
         white_noise_rms=None,
+        splits=None,
+        out=None,
     ):
         """Create a random realization of the noise power spectrum
 
@@ -749,7 +1760,9 @@ class BaseNoiseSimulator:
             Specify a seed. The seed is converted to a tuple if not already
             one and appended to (0,0,6,tube_id) to avoid collisions between
             tubes, with the signal sims and with ACT noise sims, where
-            tube_id is the integer ID of the tube.
+            tube_id is the integer ID of the tube. With the "seedsequence"
+            `random_engine`, it is the root seed of a `mapsims.seeds.SeedRegistry`
+            and the tube ID is part of the key of the random streams instead.
         nsplits : integer, optional
             Number of splits to generate. The splits will have independent noise
             realizations, with noise power scaled by a factor of nsplits, i.e. atmospheric
@@ -772,21 +1785,34 @@ class BaseNoiseSimulator:
             Optionally scale the simulation so that the small-scale limit white noise
             level is white_noise_rms in uK-arcmin (either a single number or
             a pair for the dichroic array).
+        splits : int or list of ints, optional
+            Indices of the splits to generate out of `nsplits`, by default all.
+            The selected splits are identical to the same splits of a simulation
+            of all splits. With the "seedsequence" `random_engine` only the
+            selected splits are generated, so splits can be distributed across
+            jobs; with the "legacy" engine the random numbers of all splits
+            are drawn, but only the selected splits are synthesized.
+        out : ndarray, optional
+            Preallocated C-contiguous output array with the shape of the returned maps,
+            e.g. single precision or a `np.memmap`. With `atmosphere=False`
+            the maps are generated directly in it one chunk of pixels at a time,
+            without temporary arrays of the size of the maps.
 
         Returns
         -------
 
         output_map : ndarray or ndmap
             Numpy array with the HEALPix or CAR map realization of noise.
-            The shape of the returned array is (2,3,nsplits,)+oshape, where
-            oshape is (npix,) for HEALPix and (Ny,Nx) for CAR.
-            The first dimension of size 2 corresponds to the two different
-            bands within a dichroic tube.
+            The shape of the returned array is (channel_per_tube,nsplits,3)+oshape,
+            where oshape is (npix,) for HEALPix and (Ny,Nx) for CAR.
+            The first dimension corresponds to the bands of the tube,
+            e.g. 2 for a dichroic tube.
             See the `band_id` attribute of the Channel class
             to identify which is the index of a Channel in the array.
 
             The second dimension corresponds to independent split realizations
-            of the noise, e.g. it is 1 for full mission.
+            of the noise, e.g. it is 1 for full mission, or to the selected
+            `splits`.
 
             The third dimension corresponds to the three polarization
             Stokes components I,Q,U
@@ -794,6 +1820,13 @@ class BaseNoiseSimulator:
             The last dimension is the number of pixels
         """
         assert nsplits >= 1
+        if splits is None:
+            splits = list(range(nsplits))
+        elif np.ndim(splits) == 0:
+            splits = [splits]
+        splits = [int(split) for split in splits]
+        if not all(0 <= split < nsplits for split in splits):
+            raise ValueError("splits must be between 0 and nsplits - 1")
         if mask_value is None:
             mask_value = (
                 default_mask_value["healpix"]
@@ -801,27 +1834,24 @@ class BaseNoiseSimulator:
                 else default_mask_value["car"]
             )
 
-        # This seed tuple prevents collisions with the signal sims
-        # but we should eventually switch to centralized seed
-        # tracking.
-        if seed is not None:
-            try:
-                iter(seed)
-            except:
-                seed = (seed,)
-            tube_id = self.tubes[tube][0].tube_id
-            seed = (0, 0, 6, tube_id) + seed
-            np.random.seed(seed)
+        seeds = self._get_seeds(tube, seed)
+        tube_id = self.tubes[tube][0].tube_id
 
         # In the third row we return the correlation coefficient P12/sqrt(P11*P22)
         # since that can be used straightforwardly when the auto-correlations are re-scaled.
-        ell, ps_T, ps_P, fsky, wnoise_power, weightsMap = self.get_noise_properties(
+        plan = self.get_noise_plan(
             tube,
             nsplits=nsplits,
             hitmap=hitmap,
             white_noise_rms=white_noise_rms,
             atmosphere=atmosphere,
+            output_units=output_units,
         )
+        ps_T, ps_P, wnoise_power = plan.ps_T, plan.ps_P, plan.wnoise_power
+        inv_sqrt_weights, unobserved = plan.inv_sqrt_weights, plan.unobserved
+        unit_conv = plan.unit_conv
+        if out is not None and not self.healpix:
+            out = pixell.enmap.ndmap(out, self.wcs)
 
         if not (atmosphere):
             if self.apply_beam_correction:
@@ -830,62 +1860,121 @@ class BaseNoiseSimulator:
                 )
             # If no atmosphere is requested, we use a simpler/faster method
             # that generates white noise in real-space.
-            if self.healpix:
-                ashape = (hp.nside2npix(self.nside),)
-                sel = np.s_[:, None, None, None]
-                pmap = self.pixarea_map
-            else:
-                ashape = self.shape[-2:]
-                sel = np.s_[:, None, None, None, None]
-                pmap = pixell.enmap.enmap(self.pixarea_map, self.wcs)
-            spowr = np.sqrt(wnoise_power[sel] / pmap)
-            output_map = spowr * np.random.standard_normal(
-                (self.channel_per_tube, nsplits, 3) + ashape
+            if out is None:
+                shape = (self.channel_per_tube, len(splits), 3)
+                if self.healpix:
+                    out = np.empty(shape + (hp.nside2npix(self.nside),), self.dtype)
+                else:
+                    out = pixell.enmap.empty(shape + self.shape, self.wcs, self.dtype)
+            self._simulate_white_noise(
+                out,
+                wnoise_power,
+                nsplits,
+                splits,
+                seeds,
+                tube_id,
+                inv_sqrt_weights,
+                mask_value,
+                unit_conv,
+            )
+            return out
+        hybrid = self.hybrid_ell_max is not None
+        sqrt_covariance = None
+        if seeds is not None:
+            sqrt_covariance = plan.get_sqrt_covariance(
+                self.hybrid_ell_max if hybrid else self._get_synthesis_lmax(ps_T),
+                red=hybrid,
+            )
+        if hybrid:
+            output_map = self._simulate_hybrid_noise(
+                ps_T,
+                ps_P,
+                wnoise_power,
+                nsplits,
+                seeds,
+                tube_id,
+                splits,
+                sqrt_covariance=sqrt_covariance,
             )
-            output_map[:, :, 1:, :] = output_map[:, :, 1:, :] * np.sqrt(2.0)
         else:
-            if self.healpix:
-                npix = hp.nside2npix(self.nside)
-                output_map = np.zeros((self.channel_per_tube, nsplits, 3, npix))
-                for i in range(nsplits):
-                    for i_pol in range(3):
-                        output_map[:, i, i_pol] = np.array(
-                            hp.synfast(
-                                ps_T if i_pol == 0 else ps_P,
-                                nside=self.nside,
-                                pol=False,
-                                new=True,
-                                verbose=False,
-                            )
-                        )
-            else:
-                output_map = pixell.enmap.zeros((2, nsplits, 3) + self.shape, self.wcs)
-                ps_T = pixell.powspec.sym_expand(np.asarray(ps_T), scheme="diag")
-                ps_P = pixell.powspec.sym_expand(np.asarray(ps_P), scheme="diag")
-                # TODO: These loops can probably be vectorized
-                for i in range(nsplits):
-                    for i_pol in range(3):
-                        output_map[:, i, i_pol] = pixell.curvedsky.rand_map(
-                            (self.channel_per_tube,) + self.shape,
-                            self.wcs,
-                            ps_T if i_pol == 0 else ps_P,
-                            spin=0,
-                        )
+            output_map = self._synthesize_noise(
+                ps_T,
+                ps_P,
+                nsplits,
+                seeds=seeds,
+                tube_id=tube_id,
+                splits=splits,
+                sqrt_covariance=sqrt_covariance,
+            )
 
         for i in range(self.channel_per_tube):
-            freq = self.tubes[tube][i].center_frequency
+            # flattened pixels view, all operations are in place
+            channel_map = np.asarray(output_map[i]).reshape(
+                output_map.shape[1:3] + (-1,)
+            )
             if not (self.homogeneous):
-                good = weightsMap[i] != 0
                 # Normalize on the Effective sky fraction, see discussion in:
                 # https://github.com/simonsobs/mapsims/pull/5#discussion_r244939311
-                output_map[i, :, :, good] /= np.sqrt(weightsMap[i][good][..., None, None])
-                output_map[i, :, :, np.logical_not(good)] = mask_value
-            unit_conv = (1 * u.uK_CMB).to_value(
-                u.Unit(output_units), equivalencies=u.cmb_equivalencies(freq)
-            )
-            output_map[i] *= unit_conv
+                channel_map *= inv_sqrt_weights[i]
+                channel_map[..., unobserved[i]] = mask_value
+            channel_map *= unit_conv[i]
+        if out is not None:
+            out[...] = output_map
+            return out
         return output_map
 
+    def iter_simulate(
+        self,
+        tube,
+        output_units="uK_CMB",
+        seed=None,
+        nsplits=1,
+        mask_value=None,
+        atmosphere=True,
+        hitmap=None,
+        white_noise_rms=None,
+    ):
+        """Create a random realization of the noise one split at a time
+
+        Generator alternative to `simulate`, it simulates and yields each split
+        separately, see the `splits` argument of `simulate`, so peak memory does
+        not grow with `nsplits`. The maps are identical to the splits returned
+        by `simulate` with the same arguments. The global random state of the
+        "legacy" `random_engine` cannot skip the other splits, so all splits
+        are simulated at once and then yielded, only the "seedsequence"
+        engine simulates each split separately.
+
+        Parameters
+        ----------
+        See the docstring of simulate
+
+        Yields
+        ------
+        split : int
+            Index of the split, from 0 to `nsplits - 1`
+        output_map : ndarray or ndmap
+            Maps of the split with shape (channel_per_tube, 3) + oshape,
+            see the docstring of simulate
+        """
+        kwargs = dict(
+            output_units=output_units,
+            nsplits=nsplits,
+            mask_value=mask_value,
+            atmosphere=atmosphere,
+            hitmap=hitmap,
+            white_noise_rms=white_noise_rms,
+        )
+        if self.random_engine == "legacy":
+            output_map = self.simulate(tube, seed=seed, **kwargs)
+            for split in range(nsplits):
+                yield split, output_map[:, split]
+            return
+        if seed is None:
+            # the same streams for all splits
+            seed = SeedRegistry().entropy
+        for split in range(nsplits):
+            yield split, self.simulate(tube, seed=seed, splits=[split], **kwargs)[:, 0]
+
 
 class ExternalNoiseSimulator(BaseNoiseSimulator):
     def __init__(
@@ -908,6 +1997,15 @@ class ExternalNoiseSimulator(BaseNoiseSimulator):
         cache_hitmaps=True,
         boolean_sky_fraction=False,
         survey=None,
+        dtype=np.float64,
+        noise_spectra_cache_size=32,
+        noise_spectra_cache_folder=None,
+        hybrid_ell_max=None,
+        random_engine="legacy",
+        nthreads=1,
+        hitmap_cache_folder=None,
+        hitmap_cache_size=2 ** 32,
+        hitmap_shared_memory=False,
     ):
 
         super(ExternalNoiseSimulator, self).__init__(
@@ -927,6 +2025,15 @@ class ExternalNoiseSimulator(BaseNoiseSimulator):
             cache_hitmaps=cache_hitmaps,
             boolean_sky_fraction=boolean_sky_fraction,
             channels_list=channels_list,
+            dtype=dtype,
+            noise_spectra_cache_size=noise_spectra_cache_size,
+            noise_spectra_cache_folder=noise_spectra_cache_folder,
+            hybrid_ell_max=hybrid_ell_max,
+            random_engine=random_engine,
+            nthreads=nthreads,
+            hitmap_cache_folder=hitmap_cache_folder,
+            hitmap_cache_size=hitmap_cache_size,
+            hitmap_shared_memory=hitmap_shared_memory,
         )
         self._survey = survey
 
@@ -973,6 +2080,15 @@ class SONoiseSimulator(BaseNoiseSimulator):
         cache_hitmaps=True,
         boolean_sky_fraction=False,
         instrument_parameters=DEFAULT_INSTRUMENT_PARAMETERS,
+        dtype=np.float64,
+        noise_spectra_cache_size=32,
+        noise_spectra_cache_folder=None,
+        hybrid_ell_max=None,
+        random_engine="legacy",
+        nthreads=1,
+        hitmap_cache_folder=None,
+        hitmap_cache_size=2 ** 32,
+        hitmap_shared_memory=False,
     ):
         """Simulate noise maps for Simons Observatory
 
@@ -1044,6 +2160,49 @@ class SONoiseSimulator(BaseNoiseSimulator):
             determines sky_fraction from <Nhits>.
         instrument_parameters : Path or str
             See the help of MapSims
+        dtype : numpy dtype
+            Data type of the output maps, e.g. `np.float32` to halve their memory,
+            noise spectra and spherical harmonics transforms are always computed in
+            double precision
+        noise_spectra_cache_size : int
+            Number of noise spectra kept in memory by `get_fullsky_noise_spectra`,
+            of noise plans kept in memory by `get_noise_plan` and of the weights
+            of the hitmaps, least recently used ones are removed first,
+            set to 0 to disable
+        noise_spectra_cache_folder : str
+            If provided, folder of a persistent cache of noise spectra in `.npz` files,
+            keyed on the survey parameters, so later runs do not need to call
+            the noise model, only available with `SONoiseSimulator`
+        hybrid_ell_max : int
+            If provided, the atmosphere noise is simulated in hybrid mode: only the red (1/f)
+            part of the noise spectra, i.e. the spectra minus the white noise power, is
+            synthesized, up to this ell, and the white noise is drawn in pixel space as
+            with `atmosphere=False`. Set it where the red noise becomes negligible,
+            see `validate_hybrid_noise`. Not compatible with `apply_beam_correction`.
+        random_engine : {"legacy", "seedsequence"}
+            "legacy" seeds the global numpy random state with the seed of `simulate`,
+            "seedsequence" draws each split, Stokes component and chunk of pixels from
+            an independent stream derived with `numpy.random.SeedSequence`, see
+            `mapsims.seeds`, so the maps do not depend on `nthreads`, they differ
+            from the "legacy" maps with the same seed
+        nthreads : int
+            Number of threads drawing the random numbers with the "seedsequence" engine
+        hitmap_cache_folder : str
+            If provided, folder of a persistent cache of the hitmaps and inverse variance
+            maps read from files, after the reprojection to the output geometry, in `.npy`
+            files keyed on the content of the file and the geometry, later processes
+            memory-map them instead of reading and reprojecting the original files
+        hitmap_cache_size : int
+            Maximum size in bytes of the hitmaps and inverse variance maps kept in memory
+            if `cache_hitmaps` is True, least recently used ones are removed first,
+            None for no limit
+        hitmap_shared_memory : bool or str
+            If True, the maps kept in memory are stored in `multiprocessing.shared_memory`,
+            so the processes forked from this one, e.g. the workers of `MapSims` with
+            `nprocesses` greater than 1, share a single copy of each map, if a string,
+            the prefix of the names of the shared blocks, so independent processes on
+            the same node with the same prefix, e.g. MPI ranks, share them, see
+            `mapsims.map_cache.MapCache`, requires Python 3.8 or later
         """
 
         super(SONoiseSimulator, self).__init__(
@@ -1063,6 +2222,15 @@ class SONoiseSimulator(BaseNoiseSimulator):
             cache_hitmaps=cache_hitmaps,
             boolean_sky_fraction=boolean_sky_fraction,
             instrument_parameters=instrument_parameters,
+            dtype=dtype,
+            noise_spectra_cache_size=noise_spectra_cache_size,
+            noise_spectra_cache_folder=noise_spectra_cache_folder,
+            hybrid_ell_max=hybrid_ell_max,
+            random_engine=random_engine,
+            nthreads=nthreads,
+            hitmap_cache_folder=hitmap_cache_folder,
+            hitmap_cache_size=hitmap_cache_size,
+            hitmap_shared_memory=hitmap_shared_memory,
         )
 
         self.sensitivity_mode = sensitivity_modes[sensitivity_mode]
@@ -1075,10 +2243,8 @@ class SONoiseSimulator(BaseNoiseSimulator):
 
         self.remote_data = RemoteData(healpix=self.healpix, version=self.hitmap_version)
 
-    def get_survey(self, tube):
-        """Internal function to get the survey object
-        from the SO noise model code.
-        """
+    def _get_survey_parameters(self, tube):
+        """Name of the noise model and its arguments for a tube"""
         telescope = f"{tube[0]}A"  # get LA or SA from tube name
         if telescope == "SA":
             if tube == "ST0":
@@ -1092,25 +2258,47 @@ class SONoiseSimulator(BaseNoiseSimulator):
             else:
                 raise ValueError
 
-            with np.errstate(divide="ignore", invalid="ignore"):
-                survey = so_models.SOSatV3point1(
-                    sensitivity_mode=self.sensitivity_mode,
-                    survey_efficiency=self.survey_efficiency,
-                    survey_years=self.SA_years,
-                    N_tubes=N_tubes,
-                    el=None,  # SAT does not support noise elevation function
-                    one_over_f_mode=self.SA_one_over_f_mode,
-                )
+            model_name = "SOSatV3point1"
+            model_args = dict(
+                sensitivity_mode=self.sensitivity_mode,
+                survey_efficiency=self.survey_efficiency,
+                survey_years=self.SA_years,
+                N_tubes=N_tubes,
+                el=None,  # SAT does not support noise elevation function
+                one_over_f_mode=self.SA_one_over_f_mode,
+            )
         elif telescope == "LA":
+            model_name = self.LA_noise_model
+            model_args = dict(
+                sensitivity_mode=self.sensitivity_mode,
+                survey_efficiency=self.survey_efficiency,
+                survey_years=self.LA_years,
+                N_tubes=[1, 1, 1],
+                el=self.elevation,
+            )
+        return model_name, model_args
+
+    def _get_survey_key(self, tube):
+        model_name, model_args = self._get_survey_parameters(tube)
+        return (model_name,) + tuple(
+            (name, _to_builtin(value)) for name, value in sorted(model_args.items())
+        )
+
+    def get_survey(self, tube):
+        """Internal function to get the survey object
+        from the SO noise model code.
+
+        Survey objects are cached, see `invalidate_survey_cache`.
+        """
+        # tubes with the same parameters, e.g. all LAT tubes, share the survey object
+        key = self._get_survey_key(tube)
+        if key not in self._survey_cache:
+            model_name, model_args = self._get_survey_parameters(tube)
             with np.errstate(divide="ignore", invalid="ignore"):
-                survey = getattr(so_models, self.LA_noise_model)(
-                    sensitivity_mode=self.sensitivity_mode,
-                    survey_efficiency=self.survey_efficiency,
-                    survey_years=self.LA_years,
-                    N_tubes=[1, 1, 1],
-                    el=self.elevation,
+                self._survey_cache[key] = getattr(so_models, model_name)(
+                    **model_args
                 )
-        return survey
+        return self._survey_cache[key]
 
     def _get_hitmaps_names(self,tube=None):
         """ Internal function to get the full name of the hitmaps
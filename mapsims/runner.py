@@ -1,6 +1,15 @@
+from collections import Counter
+import functools
+import hashlib
 import importlib
+import json
 import os
 import os.path
+import queue
+import sys
+import threading
+import time
+import traceback
 from astropy.table import Table
 from astropy.utils import data
 import healpy as hp
@@ -24,6 +33,7 @@ except:
 
 from so_pysm_models import get_so_models
 from .utils import DEFAULT_INSTRUMENT_PARAMETERS, merge_dict
+from . import hdf5_utils
 
 import socket
 on_cori_login = socket.gethostname().startswith("cori")
@@ -41,6 +51,9 @@ import warnings
 
 from .channel_utils import parse_channels
 
+_MPI_READY_TAG = 1
+_MPI_WORK_TAG = 2
+
 PYSM_COMPONENTS = {
     comp[0]: comp for comp in ["synchrotron", "dust", "freefree", "cmb", "ame"]
 }
@@ -129,6 +142,119 @@ def function_accepts_argument(func, arg):
     return arg in func.__code__.co_varnames
 
 
+def parse_num(num):
+    """Parse the realization numbers
+
+    Parameters
+    ----------
+    num : int, list of int or str
+        Realization number, list of numbers or string with a comma separated
+        list of numbers and inclusive ranges, e.g. "0-499", "0,5,9" or "0-4,9"
+
+    Returns
+    -------
+    nums : list of int
+        List of realization numbers
+    """
+    if isinstance(num, str):
+        nums = []
+        for item in num.split(","):
+            if "-" in item.strip()[1:]:
+                first, last = item.strip().split("-", 1)
+                nums.extend(range(int(first), int(last) + 1))
+            else:
+                nums.append(int(item))
+        return nums
+    try:
+        return [int(each) for each in num]
+    except TypeError:
+        return [int(num)]
+
+
+def _get_bandpass_key(bandpass):
+    """Hash of the content of a bandpass, frequencies in GHz and weights"""
+    freqs, weights = bandpass
+    bandpass_hash = hashlib.sha1(
+        np.atleast_1d(u.Quantity(freqs).to_value(u.GHz)).astype(np.float64).tobytes()
+    )
+    bandpass_hash.update(
+        np.atleast_1d(u.Quantity(weights).value).astype(np.float64).tobytes()
+    )
+    return bandpass_hash.hexdigest()
+
+
+def _add_component_map(output_map, component_map, mask_unseen=True):
+    """Add a component map in place into the output map
+
+    The sum is performed one (channel, split) map at a time, so that
+    temporary arrays are the size of a single map. Pixels that are unobserved
+    in `component_map`, i.e. nan or `healpy.UNSEEN` if `mask_unseen`
+    is True, are set to nan in `output_map`.
+
+    Parameters
+    ----------
+    output_map : ndarray
+        Output map with shape (nchannels, nsplits, 3) + shape, modified in place
+    component_map : ndarray
+        Component map with shape (nchannels, nsplits, 3) + shape, or
+        (nchannels, 1, 3) + shape if the component is the same for all splits
+    mask_unseen : bool
+        Whether `component_map` can contain `healpy.UNSEEN` values
+    """
+    for channel_map, channel_component_map in zip(output_map, component_map):
+        for split, split_map in enumerate(channel_map):
+            split_component_map = channel_component_map[
+                split if len(channel_component_map) > 1 else 0
+            ]
+            split_map += split_component_map
+            if mask_unseen:
+                split_map[hp.mask_bad(split_component_map)] = np.nan
+
+
+class _BackgroundWriter:
+    """Write output maps in a background thread
+
+    `put` blocks when `max_queued` maps are already waiting, so the memory
+    held by the queue is bounded. The first error raised while writing
+    stops the writes and is raised by the next call to `put` or `close`.
+    """
+
+    def __init__(self, max_queued=2):
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._error = None
+        self._error_raised = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is None:
+                write, args = item
+                try:
+                    write(*args)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_error(self):
+        if self._error is not None and not self._error_raised:
+            self._error_raised = True
+            raise self._error
+
+    def put(self, write, *args):
+        """Queue a call to the `write` function with arguments `args`"""
+        self._raise_error()
+        self._queue.put((write, args))
+
+    def close(self):
+        """Wait until all the queued maps are written"""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
 def command_line_script(args=None):
 
     import argparse
@@ -140,9 +266,10 @@ def command_line_script(args=None):
     parser.add_argument("--nside", type=int, required=False, help="NSIDE")
     parser.add_argument(
         "--num",
-        type=int,
+        type=parse_num,
         required=False,
-        help="Simulation number, generally used as seed",
+        help="Simulation number, generally used as seed, "
+        "or multiple realizations, e.g. a range 0-499 or a list 0,5,9",
     )
     parser.add_argument(
         "--nsplits", type=int, required=False, help="Number of noise splits"
@@ -153,6 +280,23 @@ def command_line_script(args=None):
         help="Channels e.g. all, 'LT1_UHF1,LT0_UHF1', 'tube:LT1', see docstring of MapSim",
         required=False,
     )
+    parser.add_argument(
+        "--nprocesses",
+        type=int,
+        default=1,
+        help="Number of local worker processes used to simulate channels in parallel, "
+        "requires the DISABLE_MPI environment variable if mpi4py is installed",
+    )
+    parser.add_argument(
+        "--mpi",
+        action="store_true",
+        help="Distribute channels and realizations across MPI ranks, requires mpi4py",
+    )
+    parser.add_argument(
+        "--background-writes",
+        action="store_true",
+        help="Write output maps in a background thread while the next channel is simulated",
+    )
     res = parser.parse_args(args)
     override = {
         key: getattr(res, key)
@@ -161,7 +305,12 @@ def command_line_script(args=None):
     }
 
     simulator = from_config(res.config, override=override)
-    simulator.execute(write_outputs=True)
+    simulator.execute(
+        write_outputs=True,
+        nprocesses=res.nprocesses,
+        mpi=res.mpi,
+        background_writes=res.background_writes,
+    )
 
 
 def import_class_from_string(class_string):
@@ -185,6 +334,8 @@ def from_config(config_file, override=None):
 
     nside = config.get("nside", None)
     car = config.get("car", False)
+    nums = parse_num(config["num"])
+    dtype = np.dtype(config.get("dtype", "float64"))
     channels = parse_channels(config["channels"], config["instrument_parameters"])
     car_resolution = config.get("car_resolution_arcmin", None)
     if car_resolution is not None:
@@ -197,8 +348,10 @@ def from_config(config_file, override=None):
     )
 
     components = {}
+    component_factories = {}
     for component_type in ["pysm_components", "other_components"]:
         components[component_type] = {}
+        component_factories[component_type] = {}
         if component_type in config:
             component_type_config = config[component_type]
             if component_type == "pysm_components":
@@ -211,29 +364,41 @@ def from_config(config_file, override=None):
             for comp_name in component_type_config:
                 comp_config = component_type_config[comp_name]
                 comp_class = import_class_from_string(comp_config.pop("class"))
-                if (
+                depends_on_num = (
                     function_accepts_argument(comp_class, "num")
-                    and "num" in config
                     and "num" not in comp_config
-                ):
+                )
+                if depends_on_num:
                     # If a component has an argument "num" and we provide a configuration
                     # "num" to MapSims, we pass it to all the class.
                     # it can be overridden by the actual component config
                     # This is used for example by `SOStandalonePrecomputedCMB`
-                    comp_config["num"] = config["num"]
+                    comp_config["num"] = nums[0]
                 if function_accepts_argument(comp_class, "shape") and shape is not None:
                     comp_config["shape"] = shape
                     comp_config["wcs"] = wcs
+                if (
+                    function_accepts_argument(comp_class, "dtype")
+                    and "dtype" not in comp_config
+                ):
+                    comp_config["dtype"] = dtype
                 components[component_type][comp_name] = comp_class(
                     nside=nside, **comp_config
                 )
+                if depends_on_num and len(nums) > 1:
+                    # Create the component again for each realization
+                    factory_config = dict(comp_config)
+                    del factory_config["num"]
+                    component_factories[component_type][comp_name] = functools.partial(
+                        comp_class, nside=nside, **factory_config
+                    )
 
     map_sim = MapSim(
         channels=config["channels"],
         nside=nside,
         car=car,
         car_resolution=car_resolution,
-        num=config["num"],
+        num=nums,
         nsplits=config.get("nsplits", 1),
         unit=config["unit"],
         tag=config["tag"],
@@ -246,6 +411,10 @@ def from_config(config_file, override=None):
         pysm_output_reference_frame=pysm_output_reference_frame,
         other_components=components["other_components"],
         instrument_parameters=config["instrument_parameters"],
+        dtype=dtype,
+        component_factories=component_factories,
+        signal_cache_folder=config.get("signal_cache_folder", None),
+        output_hdf5_filename=config.get("output_hdf5_filename", None),
     )
     return map_sim
 
@@ -268,6 +437,10 @@ class MapSim:
         pysm_custom_components=None,
         other_components=None,
         instrument_parameters=DEFAULT_INSTRUMENT_PARAMETERS,
+        dtype=np.float64,
+        component_factories=None,
+        signal_cache_folder=None,
+        output_hdf5_filename=None,
     ):
         """Run map based simulations
 
@@ -303,8 +476,12 @@ class MapSim:
             Unit of output maps
         output_folder : str
             Relative or absolute path to output folder, string template with {nside} and {tag} fields
-        num : int
-            Realization number, generally used as seed, default is 0, automatically padded to 4 digits
+        num : int, list of int or str
+            Realization number, generally used as seed, default is 0, automatically padded to 4 digits.
+            Multiple realizations can be simulated in a single run providing a list of numbers
+            or a string like "0-499" or "0,5,9", see `parse_num`, the setup (instrument parameters,
+            PySM sky, hitmaps) is performed only once. The components are created for the first
+            realization, see `component_factories` for components that depend on `num`.
         nsplits : int
             Number of noise splits, see the documentation of :py:class:`SONoiseSimulator`
         tag : str
@@ -332,7 +509,32 @@ class MapSim:
             It also assumes that in the same folder there are IPAC table files named bandpass_{tag}.tbl
             with columns:
                 bandpass_frequency, bandpass_weight
-
+        dtype : numpy dtype
+            Data type of the output maps, set to `np.float32` to halve the memory
+            needed for the output buffers, in the configuration file set `dtype = "float32"`,
+            it is also passed to all components that accept a `dtype` argument.
+            PySM and the spherical harmonics transforms still compute in double precision.
+        component_factories : dict
+            Only needed when simulating multiple realizations, dictionary with keys
+            "pysm_components" and/or "other_components", each a dictionary of component name,
+            callable pairs. Each callable takes the `num` argument and returns a new instance of the
+            component for that realization, which replaces the component with the same name.
+            `from_config` creates them for all components that get the global `num`, e.g.
+            `SOPrecomputedCMB`. Components which accept a `seed` argument in `simulate`,
+            e.g. `SONoiseSimulator`, get `num` as seed and do not need to be recreated.
+        signal_cache_folder : str
+            Folder of a persistent cache of the smoothed and rotated maps of the components
+            in `pysm_components_string`, which do not depend on `num`. Each map is saved
+            the first time it is computed, keyed on the components, the bandpass, the beam,
+            the resolution, the reference frames and the unit, and later runs load it
+            from disk instead of running PySM. Custom components, e.g. CMB, are always simulated.
+        output_hdf5_filename : str
+            If provided, write all the output maps of the run to a single HDF5 file instead of
+            FITS files, string template with {nside} and {tag} fields, it requires `h5py`.
+            Each channel of each realization is a chunked and compressed dataset
+            with shape (nsplits, 3) + map shape, HEALPix maps are in RING ordering,
+            see :py:mod:`mapsims.hdf5_utils`. With `mpi`, all ranks write in parallel
+            to uncompressed datasets, which requires `h5py` built with MPI support.
 
         """
 
@@ -349,7 +551,9 @@ class MapSim:
         )
 
         self.unit = unit
-        self.num = num
+        self.dtype = np.dtype(dtype)
+        self.nums = parse_num(num)
+        self.num = self.nums[0]
         self.nsplits = nsplits
         self.pysm_components_string = pysm_components_string
         self.pysm_custom_components = pysm_custom_components
@@ -358,158 +562,853 @@ class MapSim:
             and (pysm_custom_components is None or len(pysm_custom_components) == 0)
         )
         self.other_components = other_components
+        self.component_factories = component_factories
+        self.signal_cache_folder = signal_cache_folder
         self.tag = tag
-        self.output_folder = output_folder.format(
-            nside=self.nside, tag=self.tag, num=self.num
-        )
-        if not os.path.exists(self.output_folder):
-            os.makedirs(self.output_folder)
+        self.output_folder_template = output_folder
+        self.output_folder = self._get_output_folder(self.num)
+        # with MPI all ranks could try to create the folder
+        os.makedirs(self.output_folder, exist_ok=True)
         self.output_filename_template = output_filename_template
         self.rot = None
         self.pysm_output_reference_frame = pysm_output_reference_frame
+        self.output_hdf5_filename = output_hdf5_filename
+        self._writer = None
+        self._hdf5_file = None
+
+    def _get_output_folder(self, num):
+        return self.output_folder_template.format(
+            nside=self.nside, tag=self.tag, num=num
+        )
+
+    def _set_num(self, num):
+        """Switch to realization `num`
 
-    def execute(self, write_outputs=False):
+        It replaces the components that depend on `num` with new instances
+        created by `component_factories`, if any, and creates the output folder.
+        """
+        if num == self.num:
+            return
+        self.num = num
+        self.output_folder = self._get_output_folder(num)
+        os.makedirs(self.output_folder, exist_ok=True)
+        if self.component_factories is None:
+            return
+        for comp_name, factory in self.component_factories.get(
+            "pysm_components", {}
+        ).items():
+            comp = factory(num=num)
+            previous_comp = self.pysm_custom_components[comp_name]
+            self.pysm_custom_components[comp_name] = comp
+            if hasattr(self, "pysm_sky"):
+                self.pysm_sky.components = [
+                    comp if each is previous_comp else each
+                    for each in self.pysm_sky.components
+                ]
+        for comp_name, factory in self.component_factories.get(
+            "other_components", {}
+        ).items():
+            self.other_components[comp_name] = factory(num=num)
+
+    def _initialize_pysm_sky(self):
+        """Create the PySM Sky object from the default and custom components
+
+        It sets the `pysm_sky` and `input_reference_frame` attributes.
+        If `signal_cache_folder` is set, the components in `pysm_components_string`
+        are not included in `pysm_sky`, see `_get_fixed_signal`.
+        """
+        preset_strings = []
+        if self.pysm_components_string is not None:
+            models = self.pysm_components_string.split(",")
+            preset_strings = [model for model in models if not model.startswith("SO")]
+        if len(preset_strings) > 0:
+            self.input_reference_frame = "G"
+            assert len(preset_strings) == len(
+                models
+            ), "Cannot mix PySM and SO models, they are defined in G and C frames"
+        else:
+            self.input_reference_frame = "C"
+
+        self.pysm_sky = self._create_pysm_sky(
+            self.pysm_components_string if self.signal_cache_folder is None else None
+        )
+        # created only if a map is missing from the cache
+        self.pysm_fixed_sky = None
+
+        if self.pysm_custom_components is not None:
+            for comp_name, comp in self.pysm_custom_components.items():
+                self.pysm_sky.components.append(comp)
+
+    def _create_pysm_sky(self, pysm_components_string):
+        sky_config = []
+        preset_strings = []
+        if pysm_components_string is not None:
+            for model in pysm_components_string.split(","):
+                if model.startswith("SO"):
+                    sky_config.append(get_so_models(model, self.nside))
+                else:
+                    preset_strings.append(model)
+        return pysm.Sky(
+            nside=self.nside,
+            preset_strings=preset_strings,
+            component_objects=sky_config,
+            output_unit=u.Unit(self.unit),
+        )
+
+    def execute(
+        self, write_outputs=False, nprocesses=1, mpi=False, background_writes=False
+    ):
         """Run map simulations
 
         Execute simulations for all channels and write to disk the maps,
         unless `write_outputs` is False, then return them.
-        """
+        If multiple realizations are requested, see `num`, the setup is performed
+        once and then the realizations are simulated one after the other.
 
-        if self.run_pysm:
-            sky_config = []
-            preset_strings = []
-            if self.pysm_components_string is not None:
-                for model in self.pysm_components_string.split(","):
-                    if model.startswith("SO"):
-                        sky_config.append(get_so_models(model, self.nside))
-                    else:
-                        preset_strings.append(model)
-
-            if len(preset_strings) > 0:
-                input_reference_frame = "G"
-                assert (
-                    len(sky_config) == 0
-                ), "Cannot mix PySM and SO models, they are defined in G and C frames"
-            else:
-                input_reference_frame = "C"
+        Parameters
+        ----------
+        write_outputs : bool
+            Write the maps to disk instead of returning them
+        nprocesses : int
+            Number of local worker processes, each worker simulates a channel
+            (or a tube tuple) at a time. The default of 1 runs serially in
+            the current process. Each worker creates its own PySM sky and does
+            not use MPI for smoothing, the output maps are identical to the
+            serial run. Peak memory is about `nprocesses` times the memory
+            needed to simulate a single channel (plus the returned maps
+            if `write_outputs` is False). The workers are forked from the
+            current process, which is not supported once MPI is initialized,
+            so it requires `mpi4py` not to be imported, e.g. setting the
+            `DISABLE_MPI` environment variable.
+        mpi : bool
+            Distribute the (channel, realization) work items across the
+            ranks of `MPI.COMM_WORLD` instead of using MPI for smoothing.
+            Rank 0 dispatches work items on request of the other ranks, so
+            the load is balanced dynamically, and collects a run manifest
+            in the `manifest` attribute (written to the output folder if
+            `write_outputs` is True). With `write_outputs` False, each rank
+            returns only the maps it simulated. It requires `mpi4py`,
+            for example run with `mpirun -n 4 mapsims_run --mpi config.toml`.
+        background_writes : bool
+            Only if `write_outputs` is True, write the maps to disk in a background
+            thread while the next channel is simulated. At most 2 maps wait to be
+            written, then the simulation waits for the writer. All maps are written
+            when `execute` returns, and write errors are raised. The pool workers
+            of `nprocesses` always write synchronously.
 
-            self.pysm_sky = pysm.Sky(
-                nside=self.nside,
-                preset_strings=preset_strings,
-                component_objects=sky_config,
-                output_unit=u.Unit(self.unit),
+        Returns
+        -------
+        output : dict
+            Only if `write_outputs` is False, dictionary of channel tag, output map pairs,
+            in case of multiple realizations, dictionary of `num`, dictionary of
+            channel tag, output map pairs.
+        """
+
+        if (
+            write_outputs
+            and len(self.nums) > 1
+            and self.output_hdf5_filename is None
+            and "{num" not in self.output_folder_template
+            and "{num" not in self.output_filename_template
+        ):
+            raise ValueError(
+                "Multiple realizations need {num} in output_folder or output_filename_template"
+            )
+        if nprocesses > 1 and COMM_WORLD is not None:
+            # forking a process which initialized MPI is undefined behaviour,
+            # it can hang, and Channel objects cannot be sent to spawned workers
+            raise ValueError(
+                "Local process pools cannot be used once MPI is initialized, "
+                "set the DISABLE_MPI environment variable or use mpi=True"
             )
+        if background_writes and write_outputs and nprocesses == 1:
+            self._writer = _BackgroundWriter()
+        if (
+            write_outputs
+            and self.output_hdf5_filename is not None
+            and not mpi
+            and (COMM_WORLD is None or COMM_WORLD.rank == 0)
+        ):
+            # the same maps are simulated by all ranks, only one writes them
+            self._open_hdf5_output()
+        try:
+            if mpi:
+                if COMM_WORLD is None:
+                    raise ValueError("MPI execution requires mpi4py")
+                if nprocesses > 1:
+                    raise ValueError("Choose either MPI or a local process pool")
+                output = self._execute_mpi(COMM_WORLD, write_outputs)
+            elif nprocesses > 1:
+                import multiprocessing
 
-            if self.pysm_custom_components is not None:
-                for comp_name, comp in self.pysm_custom_components.items():
-                    self.pysm_sky.components.append(comp)
+                # Channel objects are not picklable, so workers need to inherit
+                # the simulator by forking
+                with multiprocessing.get_context("fork").Pool(
+                    processes=min(nprocesses, len(self.nums) * len(self.channels)),
+                    initializer=_initialize_pool_worker,
+                    initargs=(self,),
+                ) as pool:
+                    # workers return the maps to be written to HDF5 by this process
+                    write_hdf5 = write_outputs and self.output_hdf5_filename is not None
+                    outputs = pool.imap(
+                        _execute_channel_in_pool_worker,
+                        [
+                            (num, i, write_outputs and not write_hdf5)
+                            for num in self.nums
+                            for i in range(len(self.channels))
+                        ],
+                        chunksize=1,
+                    )
+                    output = {}
+                    for num, channel_output in outputs:
+                        if write_hdf5:
+                            for tag, channel_map in channel_output.items():
+                                channel_map = channel_map.reshape(
+                                    (-1, 3) + self.shape
+                                )
+                                for split, each_split_channel_map in enumerate(
+                                    channel_map
+                                ):
+                                    self._write_hdf5_map(
+                                        tag, num, split, each_split_channel_map
+                                    )
+                        else:
+                            output.setdefault(num, {}).update(channel_output)
+            else:
+                if self.run_pysm:
+                    self._initialize_pysm_sky()
+                output = {}
+                for num in self.nums:
+                    self._set_num(num)
+                    signal_cache = self._new_signal_cache() if self.run_pysm else None
+                    for ch in self.channels:
+                        output.setdefault(num, {}).update(
+                            self._execute_channel(
+                                ch,
+                                write_outputs,
+                                smoothing_comm=COMM_WORLD,
+                                signal_cache=signal_cache,
+                            )
+                        )
+        except BaseException as error:
+            # wait for the writer without replacing the error in flight
+            try:
+                self._close_writer()
+            except Exception as writer_error:
+                raise error from writer_error
+            raise
+        else:
+            self._close_writer()
+        finally:
+            self._close_hdf5_output()
 
         if not write_outputs:
-            output = {}
+            # with MPI a rank might not have simulated any channel
+            return output.get(self.nums[0], {}) if len(self.nums) == 1 else output
 
-        # ch can be single channel or tuple of 2 channels (tube dichroic)
-        for ch in self.channels:
-            if not isinstance(ch, tuple):
-                ch = [ch]
-            output_map_shape = (len(ch), 3) + self.shape
-            output_map = np.zeros(output_map_shape, dtype=np.float64)
+    def _execute_mpi(self, comm, write_outputs=False):
+        """Execute the work items with dynamic load balancing across MPI ranks
+
+        Rank 0 only schedules the work items and collects the manifest,
+        unless it is the only rank, the other ranks request a new work item
+        each time they complete the previous one. If a work item fails,
+        its rank sends the traceback to rank 0, which aborts the run,
+        otherwise rank 0 would wait forever for its result.
+        """
+        work_items = [(ch, num) for num in self.nums for ch in self.channels]
+        output = {}
+        manifest = []
+        if write_outputs and self.output_hdf5_filename is not None:
+            self._open_hdf5_output(comm if comm.size > 1 else None)
+
+        def execute_work_item(i):
+            ch, num = work_items[i]
+            start_time = time.time()
+            self._set_num(num)
+            output.setdefault(num, {}).update(self._execute_channel(ch, write_outputs))
+            channels = ch if isinstance(ch, tuple) else (ch,)
+            filenames = []
+            if write_outputs:
+                for each in channels:
+                    if self.output_hdf5_filename is not None:
+                        filenames.append(hdf5_utils.get_dataset_name(each.tag, num))
+                        continue
+                    for split in range(self.nsplits):
+                        filenames.append(self._get_output_filename(each, split))
+            return dict(
+                work_item=i,
+                channels=[each.tag for each in channels],
+                num=num,
+                rank=comm.rank,
+                elapsed_seconds=time.time() - start_time,
+                filenames=filenames,
+            )
+
+        if comm.rank != 0 or comm.size == 1:
             if self.run_pysm:
-                for each, channel_map in zip(ch, output_map):
-                    bandpass_integrated_map = self.pysm_sky.get_emission(
-                        *each.bandpass
-                    ).value
-                    beam_width_arcmin = each.beam
-                    # smoothing and coordinate rotation with 1 spherical harmonics transform
-                    smoothed_map = hp.ma(
-                        pysm.apply_smoothing_and_coord_transform(
-                            bandpass_integrated_map,
-                            fwhm=beam_width_arcmin,
-                            lmax=3 * self.nside - 1,
-                            rot=None
-                            if input_reference_frame == self.pysm_output_reference_frame
-                            else hp.Rotator(
-                                coord=(
-                                    input_reference_frame,
-                                    self.pysm_output_reference_frame,
-                                )
-                            ),
-                            map_dist=None
-                            if COMM_WORLD is None
-                            else pysm.MapDistribution(
-                                nside=self.nside,
-                                smoothing_lmax=3 * self.nside - 1,
-                                mpi_comm=COMM_WORLD,
-                            ),
+                self._initialize_pysm_sky()
+
+        if comm.size == 1:
+            manifest = [execute_work_item(i) for i in range(len(work_items))]
+        elif comm.rank == 0:
+            next_work_item = 0
+            active_ranks = comm.size - 1
+            status = MPI.Status()
+            while active_ranks > 0:
+                record = comm.recv(
+                    source=MPI.ANY_SOURCE, tag=_MPI_READY_TAG, status=status
+                )
+                if record is not None and "error" in record:
+                    sys.stderr.write(
+                        "Work item {work_item} failed on rank {rank}:\n{error}".format(
+                            **record
                         )
                     )
+                    sys.stderr.flush()
+                    comm.Abort(1)
+                if record is not None:
+                    manifest.append(record)
+                if next_work_item < len(work_items):
+                    comm.send(
+                        next_work_item, dest=status.Get_source(), tag=_MPI_WORK_TAG
+                    )
+                    next_work_item += 1
+                else:
+                    comm.send(None, dest=status.Get_source(), tag=_MPI_WORK_TAG)
+                    active_ranks -= 1
+        else:
+            record = None
+            while True:
+                comm.send(record, dest=0, tag=_MPI_READY_TAG)
+                i = comm.recv(source=0, tag=_MPI_WORK_TAG)
+                if i is None:
+                    break
+                try:
+                    record = execute_work_item(i)
+                except Exception:
+                    comm.send(
+                        dict(work_item=i, rank=comm.rank, error=traceback.format_exc()),
+                        dest=0,
+                        tag=_MPI_READY_TAG,
+                    )
+                    raise
 
-                    if smoothed_map.shape[0] == 1:
-                        channel_map[0] += smoothed_map
-                    else:
-                        channel_map += smoothed_map
-
-            output_map = output_map.reshape((len(ch), 1, 3) + self.shape)
-
-            if self.other_components is not None:
-                for comp in self.other_components.values():
-                    kwargs = dict(tube=ch[0].tube, output_units=self.unit)
-                    if function_accepts_argument(comp.simulate, "ch"):
-                        kwargs.pop("tube")
-                        kwargs["ch"] = ch
-                    if function_accepts_argument(comp.simulate, "nsplits"):
-                        kwargs["nsplits"] = self.nsplits
-                    if function_accepts_argument(comp.simulate, "seed"):
-                        kwargs["seed"] = self.num
-                    component_map = comp.simulate(**kwargs)
-                    if self.nsplits == 1:
-                        component_map = component_map.reshape(
-                            (len(ch), 1, 3) + self.shape
-                        )
-                    component_map[hp.mask_bad(component_map)] = np.nan
-                    output_map = output_map + component_map
-
-            for each, channel_map in zip(ch, output_map):
-                if write_outputs:
-                    for split, each_split_channel_map in enumerate(channel_map):
-                        filename = self.output_filename_template.format(
-                            telescope=each.telescope
-                            if each.tube is None
-                            else each.tube,
-                            band=each.band,
-                            nside=self.nside,
-                            tag=self.tag,
-                            num=self.num,
-                            nsplits=self.nsplits,
-                            split=split + 1,
-                        )
-                        warnings.warn("Writing output map " + filename)
-                        if self.car:
-                            pixell.enmap.write_map(
-                                os.path.join(self.output_folder, filename),
-                                each_split_channel_map,
-                                extra=dict(units=self.unit),
-                            )
-                        else:
+        if comm.rank == 0:
+            self.manifest = sorted(manifest, key=lambda record: record["work_item"])
+            if write_outputs:
+                # a manifest in each output folder, with the records of its files
+                folders = {}
+                for record in self.manifest:
+                    folder = self._get_output_folder(record["num"])
+                    folders.setdefault(folder, []).append(record)
+                for folder, records in folders.items():
+                    with open(
+                        os.path.join(folder, self.tag + "_manifest.json"), "w"
+                    ) as f:
+                        json.dump(records, f, indent=2)
+        # all files of the rank are complete before the end of the run
+        self._close_writer()
+        self._close_hdf5_output()
+        comm.Barrier()
+        return output
+
+    def _get_output_filename(self, each, split):
+        """Output filename of a channel split, `split` starts from 0"""
+        return self.output_filename_template.format(
+            telescope=each.telescope if each.tube is None else each.tube,
+            band=each.band,
+            nside=self.nside,
+            tag=self.tag,
+            num=self.num,
+            nsplits=self.nsplits,
+            split=split + 1,
+        )
+
+    def iter_execute(self):
+        """Run map simulations one channel at a time
+
+        Generator alternative to `execute(write_outputs=False)`, instead
+        of accumulating the maps of all channels, it yields each split
+        of each channel as soon as it is simulated and releases its buffers
+        before simulating the next one, so peak memory is about the memory
+        needed for a single split of a channel (or of a tube tuple) if the noise
+        uses the "seedsequence" `random_engine`, or for all the splits of a channel
+        with the "legacy" engine, for tube tuples the channels of each split
+        are yielded one after the other.
+
+        Yields
+        ------
+        channel : Channel
+            Channel object of the output map
+        split : int
+            Index of the noise split, from 0 to `nsplits - 1`
+        output_map : ndarray or ndmap
+            Output map with shape (3, npix) for HEALPix and (3, Ny, Nx) for CAR,
+            unobserved pixels are set to `healpy.UNSEEN` for HEALPix and nan for CAR.
+            In case of multiple realizations, the `num` attribute is the
+            realization of the map.
+        """
+        if self.run_pysm:
+            self._initialize_pysm_sky()
+        for num in self.nums:
+            self._set_num(num)
+            signal_cache = self._new_signal_cache() if self.run_pysm else None
+            for ch in self.channels:
+                for channels, split, output_map in self._iter_simulate_channel(
+                    ch, smoothing_comm=COMM_WORLD, signal_cache=signal_cache
+                ):
+                    for each, each_split_channel_map in zip(channels, output_map):
+                        if not self.car:
                             each_split_channel_map[
                                 np.isnan(each_split_channel_map)
                             ] = hp.UNSEEN
-                            each_split_channel_map = hp.reorder(
-                                each_split_channel_map, r2n=True
-                            )
-                            hp.write_map(
-                                os.path.join(self.output_folder, filename),
-                                each_split_channel_map,
-                                coord=self.pysm_output_reference_frame,
-                                column_units=self.unit,
-                                dtype=np.float32,
-                                overwrite=True,
-                                nest=True,
-                            )
-                else:
-                    if self.nsplits == 1:
-                        channel_map = channel_map[0]
-                    if not self.car:
-                        channel_map[np.isnan(channel_map)] = hp.UNSEEN
-                    output[each.tag] = channel_map
-        if not write_outputs:
+                        yield each, split, each_split_channel_map
+                    del output_map
+
+    def _execute_channel(
+        self, ch, write_outputs=False, smoothing_comm=None, signal_cache=None
+    ):
+        """Simulate a single channel or tube tuple and write or return the maps
+
+        Parameters
+        ----------
+        ch : Channel or tuple of Channel
+            Single channel or tuple of channels of a tube
+        write_outputs : bool
+            If True, write the maps to disk and return an empty dictionary
+        smoothing_comm : MPI communicator
+            See `_simulate_channel`
+        signal_cache : dict
+            See `_simulate_channel`
+
+        Returns
+        -------
+        output : dict
+            Dictionary of channel tag, output map pairs
+        """
+        output = {}
+        if write_outputs:
+            # write one split at a time, see `iter_execute` for the peak memory
+            for channels, split, output_map in self._iter_simulate_channel(
+                ch, smoothing_comm=smoothing_comm, signal_cache=signal_cache
+            ):
+                for each, each_split_channel_map in zip(channels, output_map):
+                    self._write_output_map(each, split, each_split_channel_map)
             return output
+        channels, output_map = self._simulate_channel(
+            ch, smoothing_comm=smoothing_comm, signal_cache=signal_cache
+        )
+        for each, channel_map in zip(channels, output_map):
+            if self.nsplits == 1:
+                channel_map = channel_map[0]
+            if not self.car:
+                channel_map[np.isnan(channel_map)] = hp.UNSEEN
+            output[each.tag] = channel_map
+        return output
+
+    def _simulate_channel(self, ch, smoothing_comm=None, signal_cache=None):
+        """Simulate a single channel or tube tuple
+
+        Parameters
+        ----------
+        ch : Channel or tuple of Channel
+            Single channel or tuple of channels of a tube
+        smoothing_comm : MPI communicator
+            If provided, all the ranks of the communicator take part
+            in the smoothing of the PySM maps
+        signal_cache : dict
+            Cache of PySM maps shared across the channels of a realization,
+            see `_new_signal_cache`
+
+        Returns
+        -------
+        channels : list or tuple of Channel
+            Channels simulated, they correspond to the first axis of `output_map`
+        output_map : ndarray or ndmap
+            Output maps with shape (len(channels), nsplits, 3) + shape,
+            unobserved pixels are set to nan
+        """
+        # ch can be single channel or tuple of 2 channels (tube dichroic)
+        if not isinstance(ch, tuple):
+            ch = [ch]
+        # Components are accumulated in place in a single buffer,
+        # the signal is the same for all splits
+        output_map = self._zeros((len(ch), self._get_output_nsplits(), 3))
+        if self.run_pysm:
+            self._add_signal(ch, output_map[:, 0], smoothing_comm, signal_cache)
+            output_map[:, 1:] = output_map[:, :1]
+
+        if self.other_components is not None:
+            for comp in self.other_components.values():
+                kwargs = self._get_component_kwargs(comp, ch)
+                component_map = comp.simulate(**kwargs)
+                _add_component_map(
+                    output_map,
+                    component_map.reshape((len(ch), -1, 3) + self.shape),
+                    mask_unseen="mask_value" not in kwargs,
+                )
+                del component_map
+
+        return ch, output_map
+
+    def _iter_simulate_channel(self, ch, smoothing_comm=None, signal_cache=None):
+        """Simulate a single channel or tube tuple one split at a time
+
+        Same as `_simulate_channel`, but the components which simulate splits
+        and have an `iter_simulate` method, e.g. `SONoiseSimulator`, generate
+        one split at a time, see their `iter_simulate` for the peak memory.
+
+        Yields
+        ------
+        channels : list or tuple of Channel
+            Channels simulated, they correspond to the first axis of `output_map`
+        split : int
+            Index of the split
+        output_map : ndarray
+            Output maps of the split with shape (len(channels), 3) + shape,
+            unobserved pixels are set to nan
+        """
+        if not isinstance(ch, tuple):
+            ch = [ch]
+        signal_map = self._zeros((len(ch), 1, 3))
+        if self.run_pysm:
+            self._add_signal(ch, signal_map[:, 0], smoothing_comm, signal_cache)
+
+        iterators = []
+        component_maps = []
+        if self.other_components is not None:
+            for comp in self.other_components.values():
+                kwargs = self._get_component_kwargs(comp, ch)
+                mask_unseen = "mask_value" not in kwargs
+                if "nsplits" in kwargs and hasattr(comp, "iter_simulate"):
+                    iterators.append((comp.iter_simulate(**kwargs), mask_unseen))
+                else:
+                    component_map = comp.simulate(**kwargs)
+                    component_maps.append(
+                        (
+                            component_map.reshape((len(ch), -1, 3) + self.shape),
+                            mask_unseen,
+                        )
+                    )
+
+        for split in range(self._get_output_nsplits()):
+            output_map = signal_map.copy()
+            for iterator, mask_unseen in iterators:
+                _, component_map = next(iterator)
+                _add_component_map(
+                    output_map, component_map[:, None], mask_unseen=mask_unseen
+                )
+                del component_map
+            for component_map, mask_unseen in component_maps:
+                if component_map.shape[1] > 1:
+                    component_map = component_map[:, split : split + 1]
+                _add_component_map(output_map, component_map, mask_unseen=mask_unseen)
+            yield ch, split, output_map[:, 0]
+            del output_map
+
+    def _zeros(self, shape):
+        """Buffer of maps with shape `shape` + map shape, filled with zeros,
+        in CAR an `ndmap` with the WCS of the outputs, the components are
+        added in place, so the buffer determines the type of the outputs"""
+        if self.car:
+            return pixell.enmap.zeros(shape + self.shape, self.wcs, dtype=self.dtype)
+        return np.zeros(shape + self.shape, dtype=self.dtype)
+
+    def _add_signal(self, ch, output_map, smoothing_comm=None, signal_cache=None):
+        """Add the PySM maps of the channels in place to `output_map`, with
+        shape (len(ch), 3) + shape, see `_simulate_channel`"""
+        for each, channel_map in zip(ch, output_map):
+            smoothed_maps = []
+            if len(self.pysm_sky.components) > 0:
+                smoothed_maps.append(
+                    self._get_smoothed_map(
+                        each,
+                        smoothing_comm=smoothing_comm,
+                        signal_cache=signal_cache,
+                    )
+                )
+            if (
+                self.signal_cache_folder is not None
+                and self.pysm_components_string is not None
+            ):
+                smoothed_maps.append(self._get_fixed_signal(each, smoothing_comm))
+            for smoothed_map in smoothed_maps:
+                if smoothed_map.shape[0] == 1:
+                    channel_map[0] += smoothed_map
+                else:
+                    channel_map += smoothed_map
+            del smoothed_maps
+
+    def _get_component_kwargs(self, comp, ch):
+        """Arguments of the `simulate` method of a component for a channel or tube tuple"""
+        kwargs = dict(tube=ch[0].tube, output_units=self.unit)
+        if function_accepts_argument(comp.simulate, "ch"):
+            kwargs.pop("tube")
+            kwargs["ch"] = ch
+        if function_accepts_argument(comp.simulate, "nsplits"):
+            kwargs["nsplits"] = self.nsplits
+        if function_accepts_argument(comp.simulate, "seed"):
+            kwargs["seed"] = self.num
+        if function_accepts_argument(comp.simulate, "mask_value"):
+            # nan propagates through the sum, no need to mask afterwards
+            kwargs["mask_value"] = np.nan
+        return kwargs
+
+    def _get_output_nsplits(self):
+        """Number of splits of the output maps, 1 if no component simulates splits"""
+        if self.other_components is not None:
+            for comp in self.other_components.values():
+                if function_accepts_argument(comp.simulate, "nsplits"):
+                    return self.nsplits
+        return 1
+
+    def _new_signal_cache(self):
+        """Create a cache of the PySM maps for a realization
+
+        Channels with the same bandpass share the bandpass integrated map
+        and channels with the same bandpass and beam also share the smoothed
+        map. The cache counts the channels using each map so that each map
+        is dropped after its last use.
+        """
+        uses = Counter()
+        for ch in self.channels:
+            for each in ch if isinstance(ch, tuple) else [ch]:
+                bandpass_key = _get_bandpass_key(each.bandpass)
+                uses[bandpass_key] += 1
+                uses[(bandpass_key, each.beam.to_value(u.arcmin))] += 1
+        return dict(maps={}, uses=uses)
+
+    def _get_smoothed_map(self, each, smoothing_comm=None, signal_cache=None):
+        """Get the bandpass integrated, smoothed and rotated PySM map of a channel
+
+        Parameters
+        ----------
+        each : Channel
+            Channel object
+        smoothing_comm : MPI communicator
+            See `_simulate_channel`
+        signal_cache : dict
+            Cache created by `_new_signal_cache`, if None, the map is always computed
+
+        Returns
+        -------
+        smoothed_map : ndarray
+            Smoothed map, it can be shared with other channels, do not modify it
+        """
+        if signal_cache is None:
+            return self._smooth_map(
+                self.pysm_sky.get_emission(*each.bandpass).value,
+                each.beam,
+                smoothing_comm,
+            )
+        maps, uses = signal_cache["maps"], signal_cache["uses"]
+        bandpass_key = _get_bandpass_key(each.bandpass)
+        smoothed_key = (bandpass_key, each.beam.to_value(u.arcmin))
+        if smoothed_key not in maps:
+            if bandpass_key not in maps:
+                maps[bandpass_key] = self.pysm_sky.get_emission(*each.bandpass).value
+            maps[smoothed_key] = self._smooth_map(
+                maps[bandpass_key], each.beam, smoothing_comm
+            )
+            # channels with the same beam won't need the bandpass integrated map
+            uses[bandpass_key] -= uses[smoothed_key]
+            if uses[bandpass_key] == 0:
+                del maps[bandpass_key]
+        smoothed_map = maps[smoothed_key]
+        uses[smoothed_key] -= 1
+        if uses[smoothed_key] == 0:
+            del maps[smoothed_key]
+        return smoothed_map
+
+    def _get_fixed_signal_key(self, each):
+        """Hash of all the inputs of the smoothed map of `pysm_components_string`"""
+        key = dict(
+            pysm_components_string=self.pysm_components_string,
+            bandpass=_get_bandpass_key(each.bandpass),
+            beam_arcmin=float(each.beam.to_value(u.arcmin)),
+            nside=self.nside,
+            shape=list(self.shape),
+            wcs=None if self.wcs is None else self.wcs.to_header_string(),
+            input_reference_frame=self.input_reference_frame,
+            pysm_output_reference_frame=self.pysm_output_reference_frame,
+            unit=u.Unit(self.unit).to_string(),
+            pysm_version=pysm.__version__,
+        )
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _get_fixed_signal(self, each, smoothing_comm=None):
+        """Get the smoothed map of the components in `pysm_components_string`
+
+        The map is loaded from `signal_cache_folder` if available, otherwise
+        it is computed and saved there.
+
+        Parameters
+        ----------
+        each : Channel
+            Channel object
+        smoothing_comm : MPI communicator
+            See `_simulate_channel`
+
+        Returns
+        -------
+        fixed_signal : ndarray
+            Smoothed map, read-only memory map if loaded from the cache
+        """
+        filename = os.path.join(
+            self.signal_cache_folder,
+            "signal_{}.npy".format(self._get_fixed_signal_key(each)),
+        )
+        if os.path.exists(filename):
+            return np.load(filename, mmap_mode="r")
+        if self.pysm_fixed_sky is None:
+            self.pysm_fixed_sky = self._create_pysm_sky(self.pysm_components_string)
+        fixed_signal = np.asarray(
+            self._smooth_map(
+                self.pysm_fixed_sky.get_emission(*each.bandpass).value,
+                each.beam,
+                smoothing_comm,
+            )
+        )
+        if smoothing_comm is None or smoothing_comm.rank == 0:
+            os.makedirs(self.signal_cache_folder, exist_ok=True)
+            # write to a temporary file first, other processes could be reading
+            temporary_filename = "{}.{}.tmp".format(filename, os.getpid())
+            with open(temporary_filename, "wb") as f:
+                np.save(f, fixed_signal)
+            os.replace(temporary_filename, filename)
+        return fixed_signal
+
+    def _smooth_map(self, bandpass_integrated_map, beam_width_arcmin, smoothing_comm):
+        # smoothing and coordinate rotation with 1 spherical harmonics transform
+        return pysm.apply_smoothing_and_coord_transform(
+            bandpass_integrated_map,
+            fwhm=beam_width_arcmin,
+            lmax=3 * self.nside - 1,
+            rot=None
+            if self.input_reference_frame == self.pysm_output_reference_frame
+            else hp.Rotator(
+                coord=(self.input_reference_frame, self.pysm_output_reference_frame)
+            ),
+            map_dist=None
+            if smoothing_comm is None
+            else pysm.MapDistribution(
+                nside=self.nside,
+                smoothing_lmax=3 * self.nside - 1,
+                mpi_comm=smoothing_comm,
+            ),
+        )
+
+    def _close_writer(self):
+        """Wait for the background writer, if any, and raise its errors"""
+        writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+
+    def _open_hdf5_output(self, comm=None):
+        """Open the HDF5 output file, with MPI create all the datasets collectively"""
+        self._hdf5_file = hdf5_utils.open_hdf5_file(
+            self.output_hdf5_filename.format(nside=self.nside, tag=self.tag), comm
+        )
+        if comm is not None:
+            for num in self.nums:
+                for ch in self.channels:
+                    for each in ch if isinstance(ch, tuple) else [ch]:
+                        self._create_hdf5_dataset(each.tag, num)
+
+    def _create_hdf5_dataset(self, tag, num):
+        return hdf5_utils.create_map_dataset(
+            self._hdf5_file,
+            tag,
+            num,
+            nsplits=self._get_output_nsplits(),
+            shape=self.shape,
+            wcs=self.wcs if self.car else None,
+            unit=self.unit,
+            coord=self.pysm_output_reference_frame,
+            # parallel HDF5 does not support compression with independent writes
+            compression=self._hdf5_file.driver != "mpio",
+        )
+
+    def _close_hdf5_output(self):
+        hdf5_file, self._hdf5_file = self._hdf5_file, None
+        if hdf5_file is not None:
+            hdf5_file.close()
+
+    def _write_output_map(self, each, split, each_split_channel_map):
+        """Write a channel split map to disk, `split` starts from 0
+
+        The map is modified in place, if a background writer is active,
+        it is queued and written later.
+        """
+        if self.output_hdf5_filename is not None:
+            if self._hdf5_file is None:
+                # another rank writes the maps
+                return
+            warnings.warn(
+                "Writing output map {} split {} to {}".format(
+                    hdf5_utils.get_dataset_name(each.tag, self.num),
+                    split + 1,
+                    self._hdf5_file.filename,
+                )
+            )
+            write, args = self._write_hdf5_map, (each.tag, self.num, split)
+        else:
+            filename = self._get_output_filename(each, split)
+            warnings.warn("Writing output map " + filename)
+            # the output folder and filename depend on `num`, resolve them now
+            write, args = (
+                self._write_map_file,
+                (os.path.join(self.output_folder, filename),),
+            )
+        if self._writer is None:
+            write(*args, each_split_channel_map)
+        else:
+            self._writer.put(write, *args, each_split_channel_map)
+
+    def _write_hdf5_map(self, tag, num, split, each_split_channel_map):
+        if not self.car:
+            each_split_channel_map[np.isnan(each_split_channel_map)] = hp.UNSEEN
+        self._create_hdf5_dataset(tag, num)[split] = each_split_channel_map
+
+    def _write_map_file(self, path, each_split_channel_map):
+        if self.car:
+            pixell.enmap.write_map(
+                path,
+                each_split_channel_map,
+                extra=dict(units=self.unit),
+            )
+        else:
+            each_split_channel_map[np.isnan(each_split_channel_map)] = hp.UNSEEN
+            each_split_channel_map = hp.reorder(each_split_channel_map, r2n=True)
+            hp.write_map(
+                path,
+                each_split_channel_map,
+                coord=self.pysm_output_reference_frame,
+                column_units=self.unit,
+                dtype=np.float32,
+                overwrite=True,
+                nest=True,
+            )
+
+
+def _initialize_pool_worker(map_sim):
+    """Initialize a worker process of `MapSim.execute`
+
+    MPI is not used in the worker, each worker smooths full maps on its own.
+    """
+    global _pool_map_sim
+    _pool_map_sim = map_sim
+    if _pool_map_sim.run_pysm:
+        _pool_map_sim._initialize_pysm_sky()
+
+
+def _execute_channel_in_pool_worker(args):
+    # Channel objects are not picklable, workers get the index in `channels`
+    num, channel_index, write_outputs = args
+    _pool_map_sim._set_num(num)
+    return (
+        num,
+        _pool_map_sim._execute_channel(
+            _pool_map_sim.channels[channel_index], write_outputs=write_outputs
+        ),
+    )
@@ -0,0 +1,109 @@
+# Reproducible random numbers for the simulations, see the `random_engine` argument
+# of the noise simulators.
+# Instead of seeding the global numpy random state, each block of random numbers,
+# identified by the component, the tube, the split, the Stokes component and
+# the chunk of pixels, is drawn from its own stream derived with
+# `numpy.random.SeedSequence`, so blocks can be drawn in any order and by
+# multiple threads with bit-identical results.
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Integer identifier of each component in the keys of the streams, the noise
+# starts from 6 as in the legacy (0, 0, 6, tube_id) seed tuple
+COMPONENT_IDS = {"noise_white": 6, "noise_atmosphere": 7}
+
+# the number of random numbers of each stream does not depend on the number
+# of threads, so the output does not depend on it either
+DEFAULT_CHUNK_SIZE = 2 ** 20
+
+
+class SeedRegistry:
+    def __init__(self, seed=None):
+        """Registry of independent random streams derived from a single seed
+
+        Parameters
+        ----------
+        seed : int or tuple of ints
+            Root seed, e.g. the realization number, if None, it is
+            drawn from the operating system entropy and saved in the
+            `entropy` attribute to reproduce the simulation later
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        try:
+            iter(seed)
+        except TypeError:
+            seed = (seed,)
+        self.entropy = tuple(int(each) for each in seed)
+
+    def get_seed_sequence(self, component, *key):
+        """SeedSequence of the stream identified by the component and
+        a tuple of non-negative integers, e.g. (tube_id, split, stokes, chunk)"""
+        return np.random.SeedSequence(
+            self.entropy, spawn_key=(COMPONENT_IDS[component],) + tuple(key)
+        )
+
+    def get_generator(self, component, *key):
+        """numpy `Generator` of the stream identified by the component and key"""
+        return np.random.Generator(
+            np.random.PCG64(self.get_seed_sequence(component, *key))
+        )
+
+    def standard_normal(
+        self, component, key, shape, nthreads=1, chunk_size=DEFAULT_CHUNK_SIZE
+    ):
+        """Draw standard normal random numbers in chunks along the last axis
+
+        Each chunk of `chunk_size` elements of the last axis, for all the leading
+        axes, is drawn from the stream `key + (chunk index,)`, the chunks are
+        distributed across `nthreads` threads, the output does not depend on it.
+
+        Parameters
+        ----------
+        component : str
+            Component name, a key of `COMPONENT_IDS`
+        key : tuple of ints
+            Identifier of the stream, e.g. (tube_id, split, stokes)
+        shape : tuple of ints
+            Shape of the output array
+        nthreads : int
+            Number of threads
+        chunk_size : int
+            Number of elements of the last axis in each chunk
+
+        Returns
+        -------
+        output : ndarray
+            Double precision array with the requested shape
+        """
+        output = np.empty(shape, dtype=np.float64)
+
+        def draw(chunk):
+            start = chunk * chunk_size
+            output[..., start : start + chunk_size] = self.standard_normal_chunk(
+                component, key, chunk, shape, chunk_size
+            )
+
+        chunks = range(-(-shape[-1] // chunk_size))
+        if nthreads > 1:
+            # numpy generators release the GIL while filling arrays
+            with ThreadPoolExecutor(nthreads) as executor:
+                list(executor.map(draw, chunks))
+        else:
+            for chunk in chunks:
+                draw(chunk)
+        return output
+
+    def standard_normal_chunk(
+        self, component, key, chunk, shape, chunk_size=DEFAULT_CHUNK_SIZE
+    ):
+        """Draw only the chunk with index `chunk` of `standard_normal`
+
+        Returns an array with shape shape[:-1] + (length of the chunk,)
+        """
+        start = chunk * chunk_size
+        stop = min(start + chunk_size, shape[-1])
+        generator = self.get_generator(component, *(tuple(key) + (chunk,)))
+        return generator.standard_normal(tuple(shape[:-1]) + (stop - start,))
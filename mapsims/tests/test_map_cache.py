@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import subprocess
+import sys
+
+import healpy as hp
+import numpy as np
+import pytest
+
+import mapsims.noise
+from mapsims.map_cache import MapCache, get_default_shared_memory_prefix, shared_memory
+
+
+def test_lru_max_bytes():
+
+    cache = MapCache(max_bytes=2 * 800)
+    maps = [np.full(100, i, dtype=np.float64) for i in range(3)]
+    for i in range(2):
+        assert cache.put(i, maps[i]) is maps[i]
+    assert cache.get(0) is maps[0]
+    cache.put(2, maps[2])
+    # 1 is the least recently used map
+    assert len(cache) == 2 and 1 not in cache
+    assert cache.nbytes == 2 * 800
+    assert cache.get(1) is None
+    # the most recent map is kept even if larger than the limit
+    cache.put(3, np.zeros(1000))
+    assert len(cache) == 1 and 3 in cache
+
+
+def test_threads():
+
+    cache = MapCache(max_bytes=10 * 80)
+
+    def put_get(i):
+        cache.put(i % 20, np.full(10, i % 20))
+        m = cache.get(i % 20)
+        assert m is None or m[0] == i % 20
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(put_get, range(1000)))
+    assert len(cache) == 10
+    assert cache.nbytes == 10 * 80
+
+
+@pytest.mark.skipif(shared_memory is None, reason="requires Python 3.8")
+def test_shared_memory():
+
+    prefix = "mapsims_test_{}".format(np.random.randint(2 ** 30))
+    first, second = MapCache(shared_memory_prefix=prefix), MapCache(
+        shared_memory_prefix=prefix
+    )
+    m = np.random.normal(size=(2, 50)).astype(np.float32)
+    try:
+        shared = first.put(("hitmap", 16), m)
+        assert not shared.flags.writeable
+        np.testing.assert_array_equal(shared, m)
+        # another cache, e.g. in another process, attaches to the same block
+        attached = second.get(("hitmap", 16))
+        assert attached.dtype == np.float32
+        np.testing.assert_array_equal(attached, m)
+        assert second.get(("hitmap", 32)) is None
+    finally:
+        first.unlink()
+    # the maps already attached are still valid
+    np.testing.assert_array_equal(attached, m)
+    assert MapCache(shared_memory_prefix=prefix).get(("hitmap", 16)) is None
+
+
+@pytest.mark.skipif(shared_memory is None, reason="requires Python 3.8")
+def test_shared_memory_eviction():
+
+    prefix = "mapsims_test_{}".format(np.random.randint(2 ** 30))
+    cache = MapCache(max_bytes=800, shared_memory_prefix=prefix)
+    maps = [np.full(100, i, dtype=np.float64) for i in range(2)]
+    try:
+        first = cache.put(0, maps[0])
+        block = cache._created_blocks[0]
+        cache.put(1, maps[1])
+        # the evicted block is removed from the system
+        assert 0 not in cache and list(cache._created_blocks) == [1]
+        with pytest.raises(FileNotFoundError):
+            shared_memory.SharedMemory(name=cache._get_block_name(0))
+        # and closed once the map is not used anymore
+        np.testing.assert_array_equal(first, maps[0])
+        assert block.buf is not None
+        del first
+        assert block.buf is None
+    finally:
+        cache.unlink()
+
+
+@pytest.mark.skipif(shared_memory is None, reason="requires Python 3.8")
+def test_shared_memory_attach_other_process():
+
+    # unrelated runs do not share the blocks
+    assert str(os.getpid()) in get_default_shared_memory_prefix()
+    prefix = "mapsims_test_{}".format(np.random.randint(2 ** 30))
+    cache = MapCache(shared_memory_prefix=prefix)
+    m = np.arange(10.0)
+    try:
+        cache.put("hitmap", m)
+        # a process which only attaches does not remove the block when it exits
+        script = (
+            "from mapsims.map_cache import MapCache; "
+            "assert MapCache(shared_memory_prefix={!r}).get('hitmap')[3] == 3"
+        ).format(prefix)
+        subprocess.run([sys.executable, "-c", script], check=True)
+        np.testing.assert_array_equal(
+            MapCache(shared_memory_prefix=prefix).get("hitmap"), m
+        )
+    finally:
+        cache.unlink()
+
+
+def test_hitmap_cache_folder(tmp_path):
+
+    hitmap_filename = str(tmp_path / "hitmap.fits")
+    hp.write_map(hitmap_filename, np.random.uniform(0, 10, hp.nside2npix(64)))
+    cache_folder = tmp_path / "cache"
+
+    def load_map():
+        simulator = mapsims.noise.BaseNoiseSimulator(
+            nside=32, hitmap_cache_folder=str(cache_folder)
+        )
+        return simulator._load_map(hitmap_filename)
+
+    expected = mapsims.noise.BaseNoiseSimulator(nside=32)._load_map(hitmap_filename)
+    np.testing.assert_array_equal(load_map(), expected)
+    assert len(list(cache_folder.glob("hitmap_*.npy"))) == 1
+    # the second time the reprojected map is memory mapped from the cache
+    cached = load_map()
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, expected)
+    hitmaps, _ = mapsims.noise.BaseNoiseSimulator(nside=32)._process_hitmaps(
+        cached[None]
+    )
+    assert hitmaps.max() == 1
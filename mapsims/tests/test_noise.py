@@ -6,6 +6,9 @@ from astropy.tests.helper import assert_quantity_allclose
 
 from astropy.utils import data
 import mapsims
+import astropy.units as u
+
+from .test_noise_extern import ELL, WHITE_NOISE, get_external_noise_simulator
 
 nside = 16
 res = np.deg2rad(30 / 60.0)
@@ -78,3 +81,307 @@ def test_no_atmosphere():
     output_map = simulator.simulate(tube, seed=seed, atmosphere=False)
 
     assert output_map[0][0][0].std() < .5
+
+
+@pytest.mark.parametrize("atmosphere", [True, False])
+def test_noise_simulator_float32(atmosphere):
+    """Single precision maps agree with double precision to ~1e-6 of the noise RMS"""
+
+    seed = 1234
+    tube = "ST3"
+
+    output_map = mapsims.SONoiseSimulator(nside=nside).simulate(
+        tube, seed=seed, atmosphere=atmosphere
+    )
+    output_map_float32 = mapsims.SONoiseSimulator(
+        nside=nside, dtype=np.float32
+    ).simulate(tube, seed=seed, atmosphere=atmosphere)
+
+    assert output_map_float32.dtype == np.float32
+    good = np.logical_not(hp.mask_bad(output_map))
+    np.testing.assert_array_equal(good, np.logical_not(hp.mask_bad(output_map_float32)))
+    np.testing.assert_allclose(
+        output_map_float32[good],
+        output_map[good],
+        rtol=1e-5,
+        atol=1e-5 * output_map[good].std(),
+    )
+
+
+def test_survey_cache():
+
+    simulator = mapsims.SONoiseSimulator(nside=nside)
+    survey = simulator.get_survey("LT0")
+    assert simulator.get_survey("LT0") is survey
+    # LAT tubes have the same survey parameters
+    assert simulator.get_survey("LT1") is survey
+    assert simulator.get_survey("ST0") is not simulator.get_survey("ST1")
+
+    simulator.LA_years = 3
+    assert simulator.get_survey("LT0") is not survey
+    simulator.LA_years = 5
+    assert simulator.get_survey("LT0") is survey
+    simulator.invalidate_survey_cache()
+    assert simulator.get_survey("LT0") is not survey
+
+
+def test_noise_spectra_cache(tmp_path):
+
+    simulator = mapsims.SONoiseSimulator(
+        nside=nside, noise_spectra_cache_folder=str(tmp_path)
+    )
+    expected_spectra = simulator.get_fullsky_noise_spectra("LT0")
+    assert len(list(tmp_path.glob("noise_spectra_*.npz"))) == 1
+    # LT0 and LT1 have the same bands
+    for spectra in [
+        simulator.get_fullsky_noise_spectra("LT1"),
+        mapsims.SONoiseSimulator(
+            nside=nside, noise_spectra_cache_folder=str(tmp_path)
+        ).get_fullsky_noise_spectra("LT0"),
+        mapsims.SONoiseSimulator(
+            nside=nside, noise_spectra_cache_size=0
+        ).get_fullsky_noise_spectra("LT0"),
+    ]:
+        for each, expected in zip(spectra, expected_spectra):
+            np.testing.assert_array_equal(each, expected)
+
+
+def test_noise_spectra_key(tmp_path):
+
+    simulator = mapsims.SONoiseSimulator(
+        nside=nside,
+        rolloff_ell=np.int64(50),
+        survey_efficiency=np.float64(0.2),
+        noise_spectra_cache_folder=str(tmp_path),
+    )
+    key = simulator._get_noise_spectra_key("LT0", np.float64(1), False)
+    # numpy scalars are converted, so the key can be serialized
+    assert simulator._get_noise_spectra_filename(key).endswith(".npz")
+    versions = dict(dict(key[1:])["versions"])
+    assert versions["mapsims"] == mapsims.__version__
+
+
+def test_alm2map_healpix():
+
+    from mapsims.noise import _alm2map_healpix
+
+    np.random.seed(1)
+    alms = np.array(
+        [
+            [hp.synalm(np.ones(3 * nside), new=True) for i_pol in range(3)]
+            for band in range(2)
+        ]
+    )
+    output_maps = _alm2map_healpix(alms, nside)
+    assert output_maps.shape == (2, 3, hp.nside2npix(nside))
+    for band in range(2):
+        for i_pol in range(3):
+            np.testing.assert_allclose(
+                output_maps[band, i_pol],
+                hp.alm2map(alms[band, i_pol], nside),
+                rtol=1e-7,
+                atol=1e-10,
+            )
+
+
+def test_hybrid_noise():
+
+    # white noise plus 1/f noise correlated between bands
+    one_over_f = (ELL / 20.0) ** -3
+    noise_TT = 0.5 * np.sqrt(np.outer(WHITE_NOISE, WHITE_NOISE))[:, :, None] * one_over_f
+    noise_TT[range(6), range(6)] = WHITE_NOISE[:, None] * (1 + one_over_f)
+    simulator = get_external_noise_simulator(noise_TT, nside=64, hybrid_ell_max=120)
+    assert simulator.simulate("ST3", seed=1, nsplits=2).shape == (
+        2,
+        2,
+        3,
+        hp.nside2npix(64),
+    )
+    # few modes in the lowest bin, so the tolerance is loose
+    validation = simulator.validate_hybrid_noise("ST3", seed=1, delta_ell=32, rtol=0.3)
+    assert validation["within_tolerance"]
+
+    # neglecting the 1/f noise at ell > 10 is not accurate
+    simulator.hybrid_ell_max = 10
+    validation = simulator.validate_hybrid_noise("ST3", seed=1, delta_ell=32, rtol=0.3)
+    assert not validation["within_tolerance"]
+
+    # no NaN or inf from the ell without power
+    simulator.hybrid_ell_max = 120
+    simulator.no_power_below_ell = 40
+    simulator.invalidate_survey_cache()
+    validation = simulator.validate_hybrid_noise("ST3", seed=1, delta_ell=32)
+    assert validation["ell"][0] > 40
+    assert np.all(np.isfinite(validation["ratio"]))
+
+
+def test_hybrid_noise_car():
+
+    from pixell import enmap
+
+    shape, wcs = enmap.fullsky_geometry(res=np.deg2rad(1))
+    simulator = get_external_noise_simulator(
+        shape=shape, wcs=wcs, ell_max=180, hybrid_ell_max=120
+    )
+    validation = simulator.validate_hybrid_noise("ST3", seed=1, delta_ell=30, rtol=0.2)
+    assert validation["within_tolerance"]
+    simulator.hybrid_ell_max = 10
+    validation = simulator.validate_hybrid_noise("ST3", seed=1, delta_ell=30, rtol=0.2)
+    assert not validation["within_tolerance"]
+
+
+def test_white_noise_out(tmp_path):
+
+    hitmaps = np.random.uniform(0.5, 1, (6, hp.nside2npix(nside)))
+    hitmaps[:, :100] = 0
+    simulator = get_external_noise_simulator(
+        WHITE_NOISE[:, None] * np.ones(len(ELL)),
+        hitmaps,
+        nside=nside,
+        dtype=np.float32,
+    )
+    expected = simulator.simulate("ST3", seed=4, nsplits=2, atmosphere=False)
+    out = np.lib.format.open_memmap(
+        str(tmp_path / "noise.npy"), mode="w+", dtype=np.float32, shape=expected.shape
+    )
+    output = simulator.simulate("ST3", seed=4, nsplits=2, atmosphere=False, out=out)
+    assert output is out
+    np.testing.assert_array_equal(out, expected)
+    assert np.all(out[..., :100] == np.float32(hp.UNSEEN))
+    # the inverse square root of the weights is computed once per tube
+    inv_sqrt_weights, unobserved = simulator._weights_cache[("ST3", None)]
+    assert inv_sqrt_weights.dtype == np.float32
+    # a few unobserved pixels are stored as indices
+    np.testing.assert_array_equal(unobserved[0], np.arange(100))
+    output = simulator.simulate("ST3", seed=4, nsplits=2)
+    assert simulator._weights_cache[("ST3", None)][0] is inv_sqrt_weights
+    assert np.all(output[..., :100] == np.float32(hp.UNSEEN))
+
+
+def test_car_pixel_area(monkeypatch):
+
+    from pixell import enmap
+
+    shape, wcs = enmap.band_geometry(np.deg2rad((-60, 30)), res=np.deg2rad(2))
+    hitmaps = np.random.uniform(0.5, 1, (6,) + shape)
+    simulator = get_external_noise_simulator(
+        WHITE_NOISE[:, None] * np.ones(len(ELL)),
+        hitmaps,
+        shape=shape,
+        wcs=wcs,
+        homogeneous=True,
+    )
+    # a single column, the area only depends on the row
+    assert simulator.pixarea_map.shape == (shape[0], 1)
+    pixarea = enmap.pixsizemap(shape, wcs)
+    np.testing.assert_allclose(
+        simulator._average(hitmaps[0]),
+        (pixarea * hitmaps[0]).sum() / simulator.map_area,
+    )
+
+    # chunks of pixels spanning multiple rows
+    monkeypatch.setattr(mapsims.noise, "DEFAULT_CHUNK_SIZE", 1000)
+    output = simulator.simulate("ST3", seed=3, atmosphere=False)
+    wnoise_power = simulator.get_noise_plan("ST3", atmosphere=False).wnoise_power
+    np.random.seed((0, 0, 6, simulator.tubes["ST3"][0].tube_id, 3))
+    expected = (
+        np.sqrt(wnoise_power[:, None, None, None, None] / pixarea)
+        * np.random.standard_normal((2, 1, 3) + shape)
+    )
+    expected[:, :, 1:] *= np.sqrt(2)
+    np.testing.assert_allclose(output, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("random_engine", ["legacy", "seedsequence"])
+@pytest.mark.parametrize("healpix", [True, False])
+def test_trichroic_tube(random_engine, healpix):
+
+    from pixell import enmap
+
+    if healpix:
+        geometry = dict(nside=64)
+        hitmap = np.ones((3, hp.nside2npix(64)))
+    else:
+        shape, wcs = enmap.fullsky_geometry(res=np.deg2rad(1))
+        geometry = dict(shape=shape, wcs=wcs, ell_max=180)
+        hitmap = enmap.ones((3,) + shape, wcs)
+    # white noise with a different correlation for each pair of bands
+    correlation = np.array([[1, 0.8, 0], [0.8, 1, -0.5], [0, -0.5, 1]])
+    cov = correlation * np.sqrt(np.outer(WHITE_NOISE[:3], WHITE_NOISE[:3]))
+    channels = [
+        mapsims.Channel(
+            "XT0_B{}".format(i),
+            "LA",
+            "B{}".format(i),
+            "XT0",
+            beam=1 * u.arcmin,
+            center_frequency=(90 + 50 * i) * u.GHz,
+            noise_band_index=i,
+            tube_id=0,
+        )
+        for i in range(3)
+    ]
+    simulator = get_external_noise_simulator(
+        cov[:, :, None] * np.ones(len(ELL)),
+        channels=channels,
+        homogeneous=True,
+        random_engine=random_engine,
+        **geometry
+    )
+    output = simulator.simulate("XT0", seed=2)
+    assert output.shape[:3] == (3, 1, 3)
+    for i_pol in range(3):
+        measured = np.corrcoef(np.reshape(output[:, 0, i_pol], (3, -1)))
+        np.testing.assert_allclose(measured, correlation, atol=0.05)
+    if random_engine == "seedsequence":
+        # the square roots of the covariance are computed once per plan
+        assert len(simulator.get_noise_plan("XT0")._sqrt_covariance) == 1
+    # one hitmap per channel
+    np.testing.assert_allclose(
+        simulator.simulate("XT0", seed=2, hitmap=hitmap), output, atol=1e-12
+    )
+
+
+def test_noise_plan(monkeypatch):
+
+    simulator = get_external_noise_simulator(nside=nside)
+    calls = []
+    get_noise_properties = simulator.get_noise_properties
+
+    def counting_get_noise_properties(*args, **kwargs):
+        calls.append(args)
+        return get_noise_properties(*args, **kwargs)
+
+    monkeypatch.setattr(simulator, "get_noise_properties", counting_get_noise_properties)
+    expected = simulator.simulate("ST3", seed=1)
+    assert not np.allclose(simulator.simulate("ST3", seed=2), expected)
+    np.testing.assert_array_equal(simulator.simulate("ST3", seed=1), expected)
+    assert len(calls) == 1
+    plan = simulator.get_noise_plan("ST3")
+    assert not plan.ps_T.flags.writeable
+    simulator.simulate("ST3", seed=1, output_units="K_RJ")
+    assert len(calls) == 2
+    # the attributes of the simulator are part of the key
+    simulator.no_power_below_ell = 10
+    assert not np.allclose(simulator.simulate("ST3", seed=1), expected)
+    assert len(calls) == 3
+    assert len(simulator._weights_cache) == 1
+    simulator.invalidate_survey_cache()
+    assert len(simulator._weights_cache) == 0
+
+
+def test_unobserved():
+
+    from mapsims.noise import _get_unobserved
+
+    observed = np.ones(1000, dtype=bool)
+    observed[:10] = False
+    unobserved = _get_unobserved(observed)
+    assert unobserved.dtype == np.int32
+    np.testing.assert_array_equal(unobserved, np.arange(10))
+    # a small footprint is stored as a boolean mask
+    observed = np.zeros(1000, dtype=bool)
+    observed[:10] = True
+    unobserved = _get_unobserved(observed)
+    assert unobserved.dtype == bool
+    np.testing.assert_array_equal(np.flatnonzero(unobserved), np.arange(10, 1000))
@@ -1,5 +1,7 @@
 from scipy.interpolate import interp1d
+import healpy as hp
 import numpy as np
+import pytest
 
 
 try:  # PySM >= 3.2.1
@@ -7,6 +9,7 @@ try:  # PySM >= 3.2.1
 except ImportError:
     import pysm.units as u
 
+import mapsims
 import mapsims.noise
 
 # An example simple survey with external noise curves and hitmaps.
@@ -200,6 +203,41 @@ class SurveyFromExternalData:
         return (ell, T_out, P_out)
 
 
+ELL = np.arange(2, 300)
+WHITE_NOISE = 1e-5 * np.arange(1, 7)
+
+
+def get_external_noise_simulator(noise_TT=None, hitmaps=None, channels=None, **kwargs):
+    """ExternalNoiseSimulator of the ST3 tube with a `SurveyFromExternalData`
+
+    By default the survey has 6 bands with white noise plus uncorrelated 1/f noise
+    and uniform hitmaps, P has twice the power of T. `kwargs` are passed to the
+    simulator and must include the geometry, `nside` or `shape` and `wcs`.
+    """
+    if noise_TT is None:
+        noise_TT = WHITE_NOISE[:, None] * (1 + (ELL / 20.0) ** -3)
+    nbands = len(noise_TT)
+    if hitmaps is None:
+        if "nside" in kwargs:
+            hitmaps = np.ones((nbands, hp.nside2npix(kwargs["nside"])))
+        else:
+            hitmaps = np.ones((nbands,) + tuple(kwargs["shape"]))
+    survey = SurveyFromExternalData(
+        nbands,
+        fwhms=np.ones(nbands) * u.arcmin,
+        noise_ell=ELL,
+        noise_TT=noise_TT,
+        noise_PP=2 * noise_TT,
+        hitmaps=hitmaps,
+        white_noises=np.sqrt(WHITE_NOISE[:nbands]),
+    )
+    if channels is None:
+        channels = mapsims.parse_channels("tube:ST3")[0]
+    return mapsims.noise.ExternalNoiseSimulator(
+        channels_list=channels, survey=survey, **kwargs
+    )
+
+
 if __name__ == "__main__":
 
     # Test that this code and the SONoiseSimulator agree if the above used the same noise curves and hitmap.
@@ -1,5 +1,7 @@
 from astropy.tests.helper import assert_quantity_allclose
 import healpy as hp
+import numpy as np
+import pytest
 
 from astropy.utils import data
 
@@ -65,3 +67,380 @@ def test_from_classes():
         data.get_pkg_data_filename("data/simonsobs_ST0_UHF1_nside16.fits.gz"), (0, 1, 2)
     )
     assert_quantity_allclose(output_map, expected_map, rtol=1e-6)
+
+
+def test_nprocesses():
+
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims")
+    )
+    simulator.channels = simulator.channels[0]  # run the 2 channels of ST0 separately
+    expected_output = simulator.execute(write_outputs=False)
+    output = simulator.execute(write_outputs=False, nprocesses=2)
+
+    assert list(output) == list(expected_output)
+    for tag, output_map in output.items():
+        assert_quantity_allclose(output_map, expected_output[tag], rtol=1e-10)
+
+
+def test_nprocesses_mpi(monkeypatch):
+
+    # the pool workers cannot be forked from a process which initialized MPI
+    monkeypatch.setattr(mapsims.runner, "COMM_WORLD", object())
+    simulator = mapsims.MapSim(channels="ST0_UHF1", nside=NSIDE, unit="uK_CMB")
+    with pytest.raises(ValueError, match="MPI"):
+        simulator.execute(write_outputs=False, nprocesses=2)
+
+
+def test_mpi():
+    """Execute with: mpirun -n 4 pytest mapsims/tests/test_runner_v02.py -k mpi"""
+
+    comm = mapsims.runner.COMM_WORLD
+    if comm is None or comm.size == 1:
+        pytest.skip("needs to be executed with mpirun")
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims")
+    )
+    simulator.channels = simulator.channels[0]  # run the 2 channels of ST0 separately
+    output = simulator.execute(write_outputs=False, mpi=True)
+    outputs = comm.gather(output, root=0)
+
+    if comm.rank == 0:
+        output = {}
+        for each in outputs:
+            output.update(each)
+        assert sorted(output) == ["ST0_UHF1", "ST0_UHF2"]
+        assert [record["channels"] for record in simulator.manifest] == [
+            ["ST0_UHF1"],
+            ["ST0_UHF2"],
+        ]
+        expected_map = hp.read_map(
+            data.get_pkg_data_filename(
+                "data/simonsobs_ST0_UHF1_nside16.fits.gz", package="mapsims.tests"
+            ),
+            (0, 1, 2),
+        )
+        assert_quantity_allclose(output["ST0_UHF1"], expected_map, rtol=1e-6)
+
+
+def test_mpi_worker_error(monkeypatch):
+
+    class Comm:
+        """Rank 1 of 2, rank 0 always sends the first work item"""
+
+        rank, size = 1, 2
+
+        def __init__(self):
+            self.sent = []
+
+        def send(self, obj, dest, tag):
+            self.sent.append(obj)
+
+        def recv(self, source, tag):
+            return 0
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("simulation failed")
+
+    simulator = mapsims.MapSim(channels="ST0_UHF1", nside=NSIDE, unit="uK_CMB")
+    monkeypatch.setattr(simulator, "_execute_channel", fail)
+    comm = Comm()
+    with pytest.raises(RuntimeError):
+        simulator._execute_mpi(comm)
+    # rank 0 receives the error instead of waiting for the result
+    assert comm.sent[-1]["work_item"] == 0
+    assert "simulation failed" in comm.sent[-1]["error"]
+
+
+def test_iter_execute():
+
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims")
+    )
+    expected_output = simulator.execute(write_outputs=False)
+    tags = []
+    for channel, split, output_map in simulator.iter_execute():
+        assert split == 0
+        tags.append(channel.tag)
+        assert_quantity_allclose(output_map, expected_output[channel.tag], rtol=1e-10)
+    assert tags == list(expected_output)
+
+
+def test_float32():
+
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims"),
+        override={"dtype": "float32"},
+    )
+    output_map = simulator.execute(write_outputs=False)[simulator.channels[0][0].tag]
+    assert output_map.dtype == np.float32
+
+    expected_map = hp.read_map(
+        data.get_pkg_data_filename(
+            "data/simonsobs_ST0_UHF1_nside16.fits.gz", package="mapsims.tests"
+        ),
+        (0, 1, 2),
+    )
+    assert_quantity_allclose(
+        output_map, expected_map, rtol=1e-5, atol=1e-5 * expected_map.std()
+    )
+
+
+def test_car_wcs(tmp_path):
+
+    enmap = pytest.importorskip("pixell.enmap")
+
+    class Offset:
+        def simulate(self, ch, output_units, nsplits):
+            return enmap.ones((len(ch), nsplits, 3) + simulator.shape, simulator.wcs)
+
+    def assert_wcs(wcs):
+        for attribute in ["cdelt", "crval", "crpix"]:
+            np.testing.assert_allclose(
+                getattr(wcs.wcs, attribute), getattr(simulator.wcs.wcs, attribute)
+            )
+
+    simulator = mapsims.MapSim(
+        channels="ST0_UHF1",
+        car=True,
+        car_resolution=5 * mapsims.runner.u.deg,
+        unit="uK_CMB",
+        nsplits=2,
+        output_folder=str(tmp_path),
+        other_components={"offset": Offset()},
+    )
+    output_map = simulator.execute(write_outputs=False)["ST0_UHF1"]
+    assert output_map.shape == (2, 3) + simulator.shape
+    assert_wcs(output_map.wcs)
+    simulator.execute(write_outputs=True)
+    for split in range(2):
+        written_map = enmap.read_map(
+            str(tmp_path / simulator._get_output_filename(simulator.channels[0], split))
+        )
+        assert_wcs(written_map.wcs)
+        np.testing.assert_array_equal(written_map, 1)
+
+
+def test_parse_num():
+
+    assert mapsims.runner.parse_num(3) == [3]
+    assert mapsims.runner.parse_num([3, 5]) == [3, 5]
+    assert mapsims.runner.parse_num("0-3") == [0, 1, 2, 3]
+    assert mapsims.runner.parse_num("0,5,9") == [0, 5, 9]
+    assert mapsims.runner.parse_num("0-2,9") == [0, 1, 2, 9]
+
+
+def test_multiple_realizations():
+
+    config_file = data.get_pkg_data_filename(
+        "data/example_config_v0.2.toml", package="mapsims"
+    )
+    output = mapsims.from_config(config_file, override={"num": "0-1"}).execute(
+        write_outputs=False
+    )
+    assert sorted(output) == [0, 1]
+    for num in [0, 1]:
+        expected_output = mapsims.from_config(
+            config_file, override={"num": num}
+        ).execute(write_outputs=False)
+        assert list(output[num]) == list(expected_output)
+        for tag, output_map in output[num].items():
+            assert_quantity_allclose(output_map, expected_output[tag], rtol=1e-10)
+    assert not np.allclose(output[0]["ST0_UHF1"], output[1]["ST0_UHF1"])
+
+
+def test_shared_bandpass(monkeypatch):
+
+    cmb = mapsims.SOPrecomputedCMB(
+        num=0,
+        nside=NSIDE,
+        lensed=False,
+        aberrated=False,
+        cmb_dir="mapsims/tests/data",
+        input_units="uK_CMB",
+    )
+    # LT0 and LT1 have the same UHF1 bandpass and beam, ST0 only the same bandpass
+    simulator = mapsims.MapSim(
+        channels="LT0_UHF1,LT1_UHF1,ST0_UHF1",
+        nside=NSIDE,
+        unit="uK_CMB",
+        pysm_custom_components={"cmb": cmb},
+        pysm_output_reference_frame="G",
+    )
+    # count the bandpass integrations
+    calls = []
+    get_emission = mapsims.runner.pysm.Sky.get_emission
+
+    def counting_get_emission(*args, **kwargs):
+        calls.append(args)
+        return get_emission(*args, **kwargs)
+
+    monkeypatch.setattr(mapsims.runner.pysm.Sky, "get_emission", counting_get_emission)
+    output = simulator.execute(write_outputs=False)
+    unique_bandpasses = {
+        mapsims.runner._get_bandpass_key(ch.bandpass) for ch in simulator.channels
+    }
+    assert len(unique_bandpasses) < len(simulator.channels)
+    # one bandpass integration per unique bandpass
+    assert len(calls) == len(unique_bandpasses)
+    monkeypatch.undo()
+
+    simulator._initialize_pysm_sky()
+    for ch in simulator.channels:
+        _, expected_map = simulator._simulate_channel(ch)
+        np.testing.assert_array_equal(output[ch.tag], expected_map[0, 0])
+
+
+def test_signal_cache_folder(tmp_path):
+
+    cmb = mapsims.SOPrecomputedCMB(
+        num=0,
+        nside=NSIDE,
+        lensed=False,
+        aberrated=False,
+        cmb_dir="mapsims/tests/data",
+        input_units="uK_CMB",
+    )
+
+    def run(signal_cache_folder):
+        simulator = mapsims.MapSim(
+            channels="tube:ST0",
+            nside=NSIDE,
+            unit="uK_CMB",
+            pysm_components_string="SO_d0",
+            pysm_custom_components={"cmb": cmb},
+            pysm_output_reference_frame="C",
+            signal_cache_folder=signal_cache_folder,
+        )
+        return simulator.execute(write_outputs=False)
+
+    expected_output = run(None)
+    first_output = run(str(tmp_path))
+    assert len(list(tmp_path.glob("signal_*.npy"))) == 2
+    second_output = run(str(tmp_path))
+    for tag, expected_map in expected_output.items():
+        assert_quantity_allclose(first_output[tag], expected_map, rtol=1e-5)
+        np.testing.assert_array_equal(second_output[tag], first_output[tag])
+
+
+def test_background_writes(tmp_path):
+
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims"),
+        override=dict(output_folder=str(tmp_path / "serial")),
+    )
+    simulator.execute(write_outputs=True)
+    simulator.output_folder = str(tmp_path / "background")
+    simulator.output_folder_template = simulator.output_folder
+    tmp_path.joinpath("background").mkdir()
+    simulator.execute(write_outputs=True, background_writes=True)
+
+    filenames = sorted(each.name for each in tmp_path.joinpath("serial").iterdir())
+    assert len(filenames) > 0
+    assert filenames == sorted(
+        each.name for each in tmp_path.joinpath("background").iterdir()
+    )
+    for filename in filenames:
+        np.testing.assert_array_equal(
+            hp.read_map(str(tmp_path / "serial" / filename), (0, 1, 2)),
+            hp.read_map(str(tmp_path / "background" / filename), (0, 1, 2)),
+        )
+
+
+def test_background_writes_error(tmp_path):
+
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims"),
+        override=dict(output_folder=str(tmp_path)),
+    )
+    simulator.output_folder = str(tmp_path / "missing")
+    with pytest.raises(OSError):
+        simulator.execute(write_outputs=True, background_writes=True)
+
+
+def test_background_writes_simulation_error(tmp_path):
+
+    class FailSecondChannel:
+        calls = 0
+
+        def simulate(self, ch, output_units):
+            self.calls += 1
+            if self.calls == 2:
+                raise RuntimeError("simulation failed")
+            return np.zeros((len(ch), 1, 3, hp.nside2npix(NSIDE)))
+
+    simulator = mapsims.MapSim(
+        channels="ST0_UHF1,ST0_UHF2",
+        nside=NSIDE,
+        unit="uK_CMB",
+        output_folder=str(tmp_path),
+        other_components={"fail": FailSecondChannel()},
+    )
+    simulator.output_folder = str(tmp_path / "missing")
+    # the simulation error is raised, the write error is its cause
+    with pytest.raises(RuntimeError) as excinfo:
+        simulator.execute(write_outputs=True, background_writes=True)
+    assert isinstance(excinfo.value.__cause__, OSError)
+
+
+def test_write_splits(tmp_path):
+
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims"),
+        override=dict(output_folder=str(tmp_path), nsplits=2),
+    )
+    expected_output = simulator.execute(write_outputs=False)
+    # splits are simulated and written one at a time
+    simulator.execute(write_outputs=True)
+    for each in simulator.channels[0]:
+        for split in range(2):
+            output_map = hp.read_map(
+                str(tmp_path / simulator._get_output_filename(each, split)), (0, 1, 2)
+            )
+            assert_quantity_allclose(
+                output_map, expected_output[each.tag][split], rtol=1e-6
+            )
+
+
+def test_hdf5_output(tmp_path):
+
+    pytest.importorskip("h5py")
+    from mapsims import hdf5_utils
+
+    filename = str(tmp_path / "{tag}.h5")
+    simulator = mapsims.from_config(
+        data.get_pkg_data_filename("data/example_config_v0.2.toml", package="mapsims"),
+        override=dict(output_folder=str(tmp_path), output_hdf5_filename=filename),
+    )
+    expected_output = simulator.execute(write_outputs=False)
+    simulator.execute(write_outputs=True)
+
+    filename = filename.format(tag=simulator.tag)
+    for tag, expected_map in expected_output.items():
+        output_map = hdf5_utils.read_map(filename, tag, num=simulator.num, split=0)
+        assert_quantity_allclose(output_map, expected_map, rtol=1e-6)
+        np.testing.assert_array_equal(
+            hdf5_utils.read_map(
+                filename, tag, num=simulator.num, split=0, pixels=slice(10, 20)
+            ),
+            output_map[:, 10:20],
+        )
+
+
+def test_hdf5_existing_dataset(tmp_path):
+
+    pytest.importorskip("h5py")
+    from mapsims import hdf5_utils
+
+    shape = (hp.nside2npix(NSIDE),)
+    with hdf5_utils.open_hdf5_file(str(tmp_path / "maps.h5")) as h5file:
+        dataset = hdf5_utils.create_map_dataset(h5file, "ST0_UHF1", 0, 2, shape)
+        dataset[0] = 1
+        # a rerun with the same layout writes to the same dataset
+        dataset = hdf5_utils.create_map_dataset(h5file, "ST0_UHF1", 0, 2, shape)
+        np.testing.assert_array_equal(dataset[0], 1)
+        for nsplits, nside in [(1, NSIDE), (2, 2 * NSIDE)]:
+            with pytest.raises(ValueError, match="already exists"):
+                hdf5_utils.create_map_dataset(
+                    h5file, "ST0_UHF1", 0, nsplits, (hp.nside2npix(nside),)
+                )
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from mapsims.seeds import SeedRegistry
+
+from .test_noise_extern import get_external_noise_simulator
+
+nside = 16
+
+
+def test_standard_normal_nthreads():
+
+    seeds = SeedRegistry(3)
+    expected = seeds.standard_normal("noise_white", (1, 0, 0), (2, 1000), chunk_size=64)
+    output = seeds.standard_normal(
+        "noise_white", (1, 0, 0), (2, 1000), nthreads=4, chunk_size=64
+    )
+    np.testing.assert_array_equal(output, expected)
+    assert abs(expected.std() - 1) < 0.1
+
+    # each chunk is the first part of its own stream
+    np.testing.assert_array_equal(
+        expected[:, 64:128],
+        seeds.get_generator("noise_white", 1, 0, 0, 1).standard_normal((2, 64)),
+    )
+    # different keys, components or seeds give different streams
+    for other in [
+        seeds.standard_normal("noise_white", (1, 0, 1), (2, 1000), chunk_size=64),
+        seeds.standard_normal("noise_atmosphere", (1, 0, 0), (2, 1000), chunk_size=64),
+        SeedRegistry(4).standard_normal(
+            "noise_white", (1, 0, 0), (2, 1000), chunk_size=64
+        ),
+    ]:
+        assert not np.allclose(other, expected)
+
+
+def test_random_entropy():
+
+    seeds = SeedRegistry()
+    np.testing.assert_array_equal(
+        SeedRegistry(seeds.entropy).standard_normal("noise_white", (0,), (10,)),
+        seeds.standard_normal("noise_white", (0,), (10,)),
+    )
+
+
+@pytest.mark.parametrize("atmosphere", [True, False])
+def test_seedsequence_engine(atmosphere):
+
+    def simulate(nthreads, seed):
+        simulator = get_external_noise_simulator(
+            nside=nside, random_engine="seedsequence", nthreads=nthreads
+        )
+        return simulator.simulate("ST3", seed=seed, nsplits=2, atmosphere=atmosphere)
+
+    expected = simulate(1, 4)
+    np.testing.assert_array_equal(simulate(3, 4), expected)
+    assert not np.allclose(simulate(1, 5), expected)
+    # independent splits
+    assert not np.allclose(expected[:, 0], expected[:, 1])
+
+
+@pytest.mark.parametrize("random_engine", ["legacy", "seedsequence"])
+@pytest.mark.parametrize("hybrid_ell_max", [None, 20])
+@pytest.mark.parametrize("atmosphere", [True, False])
+def test_splits(random_engine, hybrid_ell_max, atmosphere):
+
+    simulator = get_external_noise_simulator(
+        nside=nside, random_engine=random_engine, hybrid_ell_max=hybrid_ell_max
+    )
+    expected = simulator.simulate("ST3", seed=4, nsplits=4, atmosphere=atmosphere)
+    for splits in [[3, 1], 2]:
+        np.testing.assert_array_equal(
+            simulator.simulate(
+                "ST3", seed=4, nsplits=4, atmosphere=atmosphere, splits=splits
+            ),
+            expected[:, np.atleast_1d(splits)],
+        )
+
+
+@pytest.mark.parametrize("random_engine", ["legacy", "seedsequence"])
+def test_iter_simulate(random_engine, monkeypatch):
+
+    simulator = get_external_noise_simulator(nside=nside, random_engine=random_engine)
+    expected = simulator.simulate("ST3", seed=4, nsplits=4)
+    calls = []
+    simulate = simulator.simulate
+
+    def counting_simulate(*args, **kwargs):
+        calls.append(kwargs)
+        return simulate(*args, **kwargs)
+
+    monkeypatch.setattr(simulator, "simulate", counting_simulate)
+    for split, output_map in simulator.iter_simulate("ST3", seed=4, nsplits=4):
+        np.testing.assert_array_equal(output_map, expected[:, split])
+    # the legacy engine cannot skip splits, so it simulates all splits at once
+    assert len(calls) == (1 if random_engine == "legacy" else 4)